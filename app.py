@@ -1,95 +1,2625 @@
 import streamlit as st
-import base64
-from PIL import Image
+import hashlib
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import queue
+import re
+import contextvars
+import functools
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageChops, ImageDraw
 import io
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
-import requests
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
 from dotenv import load_dotenv
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.web.server.websocket_headers import _get_websocket_headers
+from backends import (
+    BACKEND_ROUTING, BACKENDS, OPENROUTER_URL, OpenRouterBackend, RequestTooLarge, build_backend, request_body, route
+)
+from imaging import (
+    DECODE_ERRORS, MAX_DECODE_PIXELS, data_url, encode_data_urls, encode_image, fit_image, load_working_image
+)
+from preprocess import PREPROCESS_VERSION, STAGE_PARAMS, STAGES as PREPROCESS_STAGE_FUNCTIONS, run_stages
+
+try:
+    import pymupdf  # Only needed for PDF drawings
+except ImportError:
+    pymupdf = None
+
+try:
+    import openpyxl  # Only needed for XLSX export
+except ImportError:
+    openpyxl = None
 
 load_dotenv()
 
+logger = logging.getLogger("vlmstream")
+
 API_KEY = os.getenv("API_KEY")
 
-if not API_KEY:
+if not API_KEY and "openrouter" in BACKENDS:
     st.error("❌ API key not found! Check your .env file.")
     st.stop()  
 
-API_URL = "https://openrouter.ai/api/v1/chat/completions"
+API_URL = OPENROUTER_URL
+MODEL = os.getenv("MODEL", "qwen/qwen2.5-vl-72b-instruct:free")
+
+# Models that need an explicit cache_control breakpoint; OpenAI, DeepSeek and
+# Grok models behind OpenRouter cache a stable prompt prefix automatically.
+PROMPT_CACHE_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+USER_PROMPT = "Extract the parameters from this drawing."
+MANUAL_VALUE = "Manual Identification Required"
+
+# Extraction schemas: one JSON file per component type under SCHEMA_DIR
+SCHEMA_DIR = os.getenv("SCHEMA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas"))
+CLASSIFIER_MODEL = os.getenv("CLASSIFIER_MODEL", MODEL)
+CLASSIFIER_MAX_SIDE = 512  # Component type is obvious from a thumbnail
+NUMBER = r"[Ø⌀]?\s*(-?\d+(?:[.,]\d+)?)"
+# Unit written after a text-layer number ("8 IN", "250MM", '3"'); tokens that are no unit below are ignored
+WRITTEN_UNIT = r"\s*(?P<unit>(?:°|DEG\.?)\s*[CF]\b|[A-Z]+\d?(?:/[A-Z]+)?|\")?"
+# Schema unit -> {unit a drawing may state a value in: (factor, offset) to the schema unit}, keyed as unit_key
+# spells them. A text-layer value in a known unit of no conversion here is left for the VLM.
+UNIT_CONVERSIONS = {
+    "MM": {"MM": (1, 0), "CM": (10, 0), "M": (1000, 0), "IN": (25.4, 0), "INCH": (25.4, 0), "INCHES": (25.4, 0), '"': (25.4, 0)},
+    "BAR": {"BAR": (1, 0), "MPA": (10, 0), "KPA": (0.01, 0), "PSI": (0.0689476, 0)},
+    "DEGC": {"DEGC": (1, 0), "C": (1, 0), "DEGF": (5 / 9, -160 / 9), "F": (5 / 9, -160 / 9)},
+    "L": {"L": (1, 0), "LTR": (1, 0), "LITRE": (1, 0), "LITRES": (1, 0), "ML": (0.001, 0), "GAL": (3.78541, 0)},
+    "LPM": {"LPM": (1, 0), "L/MIN": (1, 0), "GPM": (3.78541, 0)},
+    "CC/REV": {"CC/REV": (1, 0), "CM3/REV": (1, 0), "IN3/REV": (16.3871, 0)},
+    "RPM": {"RPM": (1, 0)},
+    "V": {"V": (1, 0), "VDC": (1, 0), "VAC": (1, 0)},
+}
+KNOWN_UNITS = frozenset(u for units in UNIT_CONVERSIONS.values() for u in units)
+
+# Batch export buffers this many rows before writing a Parquet row group / Arrow record batch
+EXPORT_FLUSH_ROWS = int(os.getenv("EXPORT_FLUSH_ROWS", "1000"))
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrows", "xlsx": ".xlsx"}
+
+# Largest request body the provider accepts. Images that would push a request past it
+# are reduced before anything is uploaded (see fit_image in imaging.py).
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(20 * 1024 ** 2)))
+
+# Hedged requests: when the primary call hasn't answered by the HEDGE_PERCENTILE
+# latency of recent calls, a backup goes to HEDGE_MODEL (at HEDGE_API_URL if set).
+# HEDGE_MAX_RATE caps the share of calls allowed to hedge, which bounds extra spend.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_MODEL = os.getenv("HEDGE_MODEL", "qwen/qwen2.5-vl-72b-instruct")  # Paid variant of the free model
+HEDGE_API_URL = os.getenv("HEDGE_API_URL", API_URL)
+HEDGE_API_KEY = os.getenv("HEDGE_API_KEY", API_KEY)
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_DEADLINE = float(os.getenv("HEDGE_DEFAULT_DEADLINE", "30"))  # Seconds, until enough samples
+HEDGE_MIN_DEADLINE = float(os.getenv("HEDGE_MIN_DEADLINE", "5"))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.1"))
+LATENCY_WINDOW = 200  # Recent calls kept for latency percentiles
+METRICS_TIMELINE_MINUTES = 24 * 60  # Per-minute counters kept for the operations dashboard
+
+# Record/replay of API responses. CASSETTE_MODE is "off", "record" (call the API and
+# store every successful response), "replay" (serve stored responses only, never the network)
+# or "auto" (replay when recorded, otherwise call and record).
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off")
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassette.db")
+
+PREVIEW_MAX_SIDE = 1600
+
+# Quality gate: a downscaled greyscale copy is checked before any API call. Blank,
+# washed-out, blurred and near-black scans are rejected; the rest go through the
+# preprocessing stages (see preprocess.py), which by default straighten skewed
+# scans and trim wide empty margins. QUALITY_GATE=0 skips the check, not the stages.
+QUALITY_GATE = os.getenv("QUALITY_GATE", "1") == "1"
+QUALITY_ANALYSIS_SIDE = 1024
+QUALITY_MIN_CONTRAST = float(os.getenv("QUALITY_MIN_CONTRAST", "0.2"))  # p1-p99 grey range, as a fraction
+QUALITY_MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", "0.01"))  # Laplacian variance near ink / range²
+QUALITY_INK_RANGE = (0.001, 0.6)  # Share of dark pixels outside which a sheet is blank or near-black
+PREPROCESS_STAGES = [s for s in os.getenv("PREPROCESS_STAGES", "deskew,trim").split(",") if s]
+if set(PREPROCESS_STAGES) - set(PREPROCESS_STAGE_FUNCTIONS):
+    raise ValueError(f"Unknown PREPROCESS_STAGES; choose from {', '.join(PREPROCESS_STAGE_FUNCTIONS)}")
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(os.cpu_count() or 2)))
+PREPROCESS_CACHE_DIR = os.getenv("PREPROCESS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "vlmstream-preprocess"))
+PREPROCESS_CACHE_BYTES = int(os.getenv("PREPROCESS_CACHE_BYTES", str(1024 ** 3)))
+
+# Adaptive resolution: drawings go out at the first rung of RESOLUTION_LADDER (long
+# side in pixels, 0 = full working resolution) and climb only while fields fail
+# validation or ADAPTIVE_MISSING_FIELDS or more are empty. A zoomed title-block crop
+# is the last resort for fields still missing after full resolution.
+ADAPTIVE_RESOLUTION = os.getenv("ADAPTIVE_RESOLUTION", "0") == "1"
+RESOLUTION_LADDER = [int(r) for r in os.getenv("RESOLUTION_LADDER", "1024,2048,0").split(",")]
+ADAPTIVE_MISSING_FIELDS = int(os.getenv("ADAPTIVE_MISSING_FIELDS", "3"))
+TITLE_BLOCK_FIELDS = ["DRAWING NUMBER"]
+TITLE_BLOCK_BOX = (0.55, 0.7, 1.0, 1.0)  # Bottom-right corner, as fractions of width/height
+
+# SQLite results store shared by the watch-folder daemon and batch jobs
+RESULTS_DB = os.getenv("RESULTS_DB", "results.db")
+
+# Revision diffing: a new revision of a stored DRAWING NUMBER is compared pixel by
+# pixel with the stored image of the previous one, and only changed regions are re-read.
+REVISION_MAX_SIDE = int(os.getenv("REVISION_MAX_SIDE", "2048"))  # Stored and compared at this size
+REVISION_PIXEL_THRESHOLD = 48  # Grey-level difference that counts as a change; absorbs scan noise
+REVISION_GRID = 32  # Change-mask cells along the longer side
+REVISION_MAX_CHANGED = float(os.getenv("REVISION_MAX_CHANGED", "0.4"))  # Past this, re-extract the whole sheet
+REVISION_MAX_REGIONS = int(os.getenv("REVISION_MAX_REGIONS", "6"))
+
+# Shared artifact store: previews and result tables are kept once per content hash
+# in memory-mapped files rather than copied into every browser session's state.
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "vlmstream-artifacts"))
+ARTIFACT_STORE_MAX_BYTES = int(os.getenv("ARTIFACT_STORE_MAX_BYTES", str(2 * 1024 ** 3)))
+ARTIFACT_SESSION_QUOTA = int(os.getenv("ARTIFACT_SESSION_QUOTA", str(256 * 1024 ** 2)))
+
+# Multi-image batching: only small, clean sheets share a request, and K is
+# bounded by the model's context window as well as MAX_BATCH_SIZE.
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+BATCH_MAX_PIXELS = int(os.getenv("BATCH_MAX_PIXELS", str(1600 * 1200)))
+MODEL_CONTEXT_TOKENS = {
+    "qwen/qwen2.5-vl-72b-instruct:free": 32000,
+    "qwen/qwen2.5-vl-72b-instruct": 32000,
+}
+DEFAULT_CONTEXT_TOKENS = 32000
+RESPONSE_TOKENS_PER_DRAWING = 300
+
+# Batch runs encode requests in the preprocessing process pool while earlier ones are
+# on the wire. Up to PIPELINE_QUEUE_DEPTH encoded requests wait for one of the
+# PIPELINE_IO_WORKERS connections; while they do, no further encoding starts.
+PIPELINE_IO_WORKERS = int(os.getenv("PIPELINE_IO_WORKERS", "4"))
+PIPELINE_QUEUE_DEPTH = int(os.getenv("PIPELINE_QUEUE_DEPTH", "8"))
+
+# Zip and tar archives in a batch are read member by member, never unpacked whole
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tgz", ".tar.gz", ".tbz2", ".tar.bz2", ".txz", ".tar.xz")
+ARCHIVE_MEMBER_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".pdf")
+ARCHIVE_MAX_MEMBER_BYTES = int(os.getenv("ARCHIVE_MAX_MEMBER_BYTES", str(256 * 1024 ** 2)))  # Guards against zip bombs
+
+# Token budget governor for batch runs (0 disables a budget). Past BUDGET_DOWNGRADE_AT
+# of either budget, requests switch to the fallback model at a lower resolution;
+# when the hourly budget is full they wait for the window to free up.
+HOURLY_TOKEN_BUDGET = int(os.getenv("HOURLY_TOKEN_BUDGET", "0"))
+BATCH_TOKEN_BUDGET = int(os.getenv("BATCH_TOKEN_BUDGET", "0"))
+BUDGET_DOWNGRADE_AT = float(os.getenv("BUDGET_DOWNGRADE_AT", "0.8"))
+BUDGET_FALLBACK_MODEL = os.getenv("BUDGET_FALLBACK_MODEL", MODEL)
+BUDGET_FALLBACK_MAX_SIDE = int(os.getenv("BUDGET_FALLBACK_MAX_SIDE", "1024"))
+BUDGET_MAX_WAIT = float(os.getenv("BUDGET_MAX_WAIT", "900"))  # Seconds a request may wait for the hourly budget
+
+# Fair sharing of the API key between users of this server. At most SCHEDULER_SLOTS
+# calls run at once; SCHEDULER_INTERACTIVE_SLOTS of them are kept for single-drawing
+# work, so an upload never queues behind someone's batch. Batch calls are shared out
+# by weighted round-robin, at most SCHEDULER_USER_SLOTS per user at a time. Users are
+# told apart by SCHEDULER_USER_HEADER (set by an authenticating proxy) or, without
+# one, by browser session. SCHEDULER_WEIGHTS is "user=weight,..."; the default is 1.
+SCHEDULER_SLOTS = int(os.getenv("SCHEDULER_SLOTS", "8"))
+SCHEDULER_INTERACTIVE_SLOTS = int(os.getenv("SCHEDULER_INTERACTIVE_SLOTS", "2"))
+SCHEDULER_USER_SLOTS = int(os.getenv("SCHEDULER_USER_SLOTS", "4"))
+SCHEDULER_USER_HEADER = os.getenv("SCHEDULER_USER_HEADER", "")
+SCHEDULER_WEIGHTS = {
+    user.strip(): int(weight) for user, weight in
+    (entry.split("=", 1) for entry in os.getenv("SCHEDULER_WEIGHTS", "").split(",") if "=" in entry)
+}
+
+# Self-consistency voting: only drawings flagged low-confidence get extra samples,
+# spread over these temperatures and models and run concurrently.
+VOTING_SAMPLES = int(os.getenv("VOTING_SAMPLES", "3"))
+VOTING_TEMPERATURES = [float(t) for t in os.getenv("VOTING_TEMPERATURES", "0.0,0.5,0.9").split(",")]
+VOTING_MODELS = [m for m in os.getenv("VOTING_MODELS", "").split(",") if m] or [MODEL]
+LOW_CONFIDENCE_MISSING_FIELDS = int(os.getenv("LOW_CONFIDENCE_MISSING_FIELDS", "4"))
+
+# Vector PDF pre-pass: fields read from the text layer skip the VLM entirely, and
+# the VLM is only called when one of the schema's text_layer_required fields is unresolved.
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", "200"))
+
+# Reply parsing. Keys are matched to schema fields after dropping bullets, markdown,
+# unit suffixes such as "(MM)" and punctuation, and expanding common abbreviations.
+KEY_ABBREVIATIONS = {
+    "DIA": "DIAMETER", "DIAM": "DIAMETER", "NO": "NUMBER", "NR": "NUMBER", "NUM": "NUMBER",
+    "DWG": "DRAWING", "DRG": "DRAWING", "PRESS": "PRESSURE", "TEMP": "TEMPERATURE",
+    "MAXIMUM": "MAX", "MINIMUM": "MIN", "OPER": "OPERATING", "OPR": "OPERATING", "LG": "LENGTH",
+    "LEN": "LENGTH", "VOL": "VOLUME", "CONN": "CONNECTION", "DISP": "DISPLACEMENT", "OD": "OUTSIDE DIAMETER",
+}
+EMPTY_VALUES = {"", "N/A", "NA", "-", "--", "—", "NONE", "UNKNOWN", "NOT VISIBLE", "NOT SPECIFIED", '""'}
+QUOTES = "\"'`"
+# First characters of values that may be empty or quoted; every other value is kept as it is
+VALUE_CHECK_FIRST = frozenset({v[:1] for v in EMPTY_VALUES if v} | {v[:1].lower() for v in EMPTY_VALUES if v} | set(QUOTES))
+KEY_BULLET = re.compile(r"^[\s\-*•·>]*(?:\d{1,2}[.)]\s+)?")
+KEY_UNIT_SUFFIX = re.compile(r"\s*[(\[][^)\]]*[)\]]\s*$")
+KEY_NON_WORD = re.compile(r"[^A-Z0-9]+")
+ALIAS_TABLE_MAX = 4096  # Reply key spellings remembered per alias table
+PARSED_LINES_MAX = 20000  # Reply field lines remembered per schema, with their parsed value
+
+@functools.lru_cache(maxsize=4096)  # Replies repeat the same few dozen key spellings
+def normalize_key(key):
+    key = KEY_UNIT_SUFFIX.sub("", KEY_BULLET.sub("", key).strip(" \t*_\"'").upper())
+    words = KEY_NON_WORD.sub(" ", key.replace("#", " NUMBER ")).split()
+    return " ".join(KEY_ABBREVIATIONS.get(w, w) for w in words)
+
+def build_alias_table(fields, aliases=None):
+    """Normalised key variant -> canonical field name.
+
+    Besides each field and its listed aliases, a leading run of words that only
+    one field starts with ("STROKE" for STROKE LENGTH) is accepted too.
+    """
+    table = {}
+    prefixes = Counter()
+    for field in fields:
+        words = normalize_key(field).split()
+        prefixes.update({" ".join(words[:n]) for n in range(1, len(words))})
+    for field in fields:
+        words = normalize_key(field).split()
+        for n in range(1, len(words)):
+            prefix = " ".join(words[:n])
+            if prefixes[prefix] == 1 and prefix not in table:
+                table[prefix] = field
+    for field in fields:
+        for variant in [field] + (aliases or {}).get(field, []):
+            table[normalize_key(variant)] = field
+    return table
+
+class ExtractionSchema:
+    """Fields, units, prompt text and validation rules for one component type."""
+
+    def __init__(self, spec):
+        self.name = spec["name"]
+        self.title = spec.get("title", self.name.title())
+        self.keywords = [re.compile(r"\b" + re.escape(k) + r"\b", re.IGNORECASE) for k in spec.get("keywords", [])]
+        self.fields = [f["name"] for f in spec["fields"]]
+        self.units = {f["name"]: f["unit"] for f in spec["fields"] if f.get("unit")}
+        self.text_layer_required = spec.get("text_layer_required", [])
+        self.aliases = build_alias_table(self.fields, {f["name"]: f.get("aliases", []) for f in spec["fields"]})
+        self.parsed_lines = {}
+
+        # field: (pattern the value must contain, min, max) - numeric bounds apply to fields with a unit
+        self.rules = {}
+        # field: (label regex, value regex, the field's unit or None)
+        self.text_layer = {}
+        for field in spec["fields"]:
+            name = field["name"]
+            pattern = field.get("pattern") or (r"\d" if name in self.units else None)
+            self.rules[name] = (
+                re.compile(pattern, re.IGNORECASE) if pattern else None,
+                field.get("min"),
+                field.get("max"),
+            )
+            if field.get("text_label"):
+                value = field.get("text_value", NUMBER + (WRITTEN_UNIT if name in self.units else ""))
+                self.text_layer[name] = (
+                    re.compile(field["text_label"], re.IGNORECASE),
+                    re.compile(r"^[\s:=\-]*" + value, re.IGNORECASE),
+                    self.units.get(name),
+                )
+
+        # Identical for every drawing of this type, so it lives in the system message
+        # where it can be served from the provider's prompt cache.
+        rules = [
+            "If a value is missing or unclear, return an empty string. DO NOT estimate any values.",
+            "Convert values to the specified units where applicable.",
+        ] + spec.get("rules", []) + ["Extract and return data in this format:"]
+        self.system_prompt = (
+            "Analyze the engineering drawing and extract only the values that are clearly visible in the image.\n"
+            "STRICT RULES:\n"
+            + "".join(f"{i}) {rule}\n" for i, rule in enumerate(rules, start=1))
+            + "\n".join(f"{f['name']}: {f.get('prompt', '')}" for f in spec["fields"])
+        )
+
+    def validate(self, parsed_results):
+        """Return {field: problem} for values that break the schema's rules. Missing values are not errors."""
+        problems = {}
+        for name, (pattern, low, high) in self.rules.items():
+            value = parsed_results.get(name, "")
+            if value in ("", MANUAL_VALUE):
+                continue
+            if pattern is not None and not pattern.search(value):
+                problems[name] = f"unexpected value {value!r}"
+                continue
+            number = to_number(value) if name in self.units else None
+            if number is not None and ((low is not None and number < low) or (high is not None and number > high)):
+                problems[name] = f"{number:g} {self.units[name]} outside {low}-{high}"
+        return problems
+
+def load_schemas(directory=SCHEMA_DIR):
+    schemas = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".json"):
+            with open(os.path.join(directory, filename), encoding="utf-8") as f:
+                schema = ExtractionSchema(json.load(f))
+            schemas[schema.name] = schema
+    return schemas
+
+SCHEMAS = load_schemas()
+ALL_FIELD_ALIASES = build_alias_table(
+    list(dict.fromkeys(f for schema in SCHEMAS.values() for f in schema.fields)),
+    {f: [a for a, c in schema.aliases.items() if c == f] for schema in SCHEMAS.values() for f in schema.fields}
+)
+ALL_FIELD_PARSED_LINES = {}
+DEFAULT_SCHEMA = SCHEMAS[os.getenv("DEFAULT_SCHEMA", "cylinder")]
+SYSTEM_PROMPT = DEFAULT_SCHEMA.system_prompt
+PARAMETERS = DEFAULT_SCHEMA.fields
+
+def process_singleton(factory):
+    """Share one instance per process.
+
+    Streamlit re-executes this script on every rerun, so module globals don't survive;
+    st.cache_resource does, but only under the Streamlit runtime, so plain scripts get lru_cache.
+    """
+    in_streamlit = st.cache_resource(factory)
+    in_script = functools.lru_cache(maxsize=None)(factory)
+
+    @functools.wraps(factory)
+    def get():
+        return in_streamlit() if st.runtime.exists() else in_script()
+
+    def clear():
+        in_streamlit.clear()
+        in_script.cache_clear()
+    get.clear = clear  # The next call creates a fresh instance
+    return get
+
+class Metrics:
+    """Thread-safe counters, gauges, a per-minute timeline and a rolling window of API call latencies."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.gauges = Counter()
+        self.timeline = {}  # Epoch minute -> Counter of increments in that minute
+        self.latencies = deque(maxlen=window)
+
+    def incr(self, name, amount=1):
+        minute = int(time.time() // 60)
+        with self.lock:
+            self.counters[name] += amount
+            self.timeline.setdefault(minute, Counter())[name] += amount
+            if len(self.timeline) > METRICS_TIMELINE_MINUTES:
+                del self.timeline[min(self.timeline)]
+
+    def gauge(self, name, delta):
+        with self.lock:
+            self.gauges[name] += delta
+
+    def recent(self, name, minutes):
+        """Sum of a counter over the last `minutes` minutes, including the current one."""
+        now = int(time.time() // 60)
+        with self.lock:
+            return sum(self.timeline.get(m, {}).get(name, 0) for m in range(now - minutes + 1, now + 1))
+
+    def series(self, names, minutes=60):
+        """Per-minute values of the given counters as a DataFrame indexed by time."""
+        now = int(time.time() // 60)
+        with self.lock:
+            rows = [
+                {name: self.timeline.get(m, {}).get(name, 0) for name in names}
+                for m in range(now - minutes + 1, now + 1)
+            ]
+        index = pd.to_datetime([m * 60 for m in range(now - minutes + 1, now + 1)], unit="s")
+        return pd.DataFrame(rows, index=index)
 
-def encode_image_to_base64(image_bytes):
-    return "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode("utf-8")
+    def observe_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
 
-def parse_ai_response(response_text):
-    """Parse the AI response into a structured format. If a value is missing, return 'Manual Identification Required'."""
+    def latency_percentile(self, percentile):
+        with self.lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            counters.update(self.gauges)
+        hedged = counters.get("hedged_calls", 0)
+        requests_made = counters.get("api_calls", 0) - hedged  # Backups aren't separate requests
+        counters["hedge_rate"] = hedged / requests_made if requests_made else 0.0
+        counters["p50_latency_s"] = self.latency_percentile(50)
+        counters["p95_latency_s"] = self.latency_percentile(95)
+        return counters
+
+@process_singleton
+def get_metrics():
+    return Metrics()
+
+class QueueDepth:
+    """A batch run's drawings still waiting for a result, mirrored in the queue_depth gauge.
+
+    Results arrive on worker threads, so the count moves under a lock.
+    """
+
+    def __init__(self, metrics, count):
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.count = count
+        metrics.gauge("queue_depth", count)
+
+    def dequeue(self, *_):
+        with self.lock:
+            if not self.count:
+                return
+            self.count -= 1
+        self.metrics.gauge("queue_depth", -1)
+
+    def clear(self):
+        """Take the drawings that never got a result off the gauge."""
+        with self.lock:
+            count, self.count = self.count, 0
+        self.metrics.gauge("queue_depth", -count)
+
+@process_singleton
+def get_hedge_executor():
+    # Abandoned requests keep running here until their HTTP call returns
+    return ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+class TokenBudget:
+    """Tokens spent over a sliding window, or over the object's lifetime when window is None.
+
+    Estimates are reserved before a request is sent and swapped for the reported
+    usage when it returns, so concurrent requests can't overshoot the limit together.
+    """
+
+    def __init__(self, limit, window=None):
+        self.limit = limit
+        self.window = window
+        self.cond = threading.Condition()
+        self.spent = deque()  # (timestamp, tokens)
+        self.total = 0
+        self.reserved = 0
+
+    def used(self):
+        if self.window is not None:
+            cutoff = time.time() - self.window
+            while self.spent and self.spent[0][0] < cutoff:
+                self.total -= self.spent.popleft()[1]
+        return self.total + self.reserved
+
+    def used_fraction(self, tokens=0):
+        if not self.limit:
+            return 0.0
+        with self.cond:
+            return (self.used() + tokens) / self.limit
+
+    def reserve(self, tokens, timeout=0.0):
+        """Reserve tokens, waiting up to timeout seconds for room. Returns False if they don't fit."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.limit and self.used() + tokens > self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                # Woken early by settle(); otherwise when the oldest spend leaves the window
+                expires = self.spent[0][0] + self.window - time.time() if self.window and self.spent else remaining
+                self.cond.wait(min(remaining, max(0.1, expires)))
+            self.reserved += tokens
+            return True
+
+    def settle(self, reserved, actual):
+        with self.cond:
+            self.reserved -= reserved
+            self.spent.append((time.time(), actual))
+            self.total += actual
+            self.cond.notify_all()
+
+@process_singleton
+def get_hourly_budget():
+    return TokenBudget(HOURLY_TOKEN_BUDGET, window=3600)
+
+class FairScheduler:
+    """Hands out API call slots: the interactive lane first, then batch work by weighted round-robin.
+
+    Every waiting call holds a ticket in the interactive lane or its user's queue.
+    Whenever a slot frees, interactive tickets are granted first. Batch tickets go to
+    users in rotation, each getting up to its weight in grants per turn, never more
+    than per_user calls at once, and never the interactive_slots kept free for uploads.
+    """
+
+    def __init__(self, slots, interactive_slots, per_user, weights=None):
+        self.cond = threading.Condition()
+        self.slots = slots
+        self.batch_slots = max(1, slots - interactive_slots)
+        self.per_user = per_user
+        self.weights = weights or {}
+        self.running = 0
+        self.batch_running = Counter()  # user -> batch calls in flight
+        self.interactive = deque()
+        self.queues = OrderedDict()  # user -> waiting batch tickets; the first user has the turn
+        self.turn_grants = 0
+
+    def next_batch_ticket(self):
+        for _ in range(len(self.queues) + 1):
+            user, tickets = next(iter(self.queues.items()))
+            if self.turn_grants < self.weights.get(user, 1) and self.batch_running[user] < self.per_user:
+                self.turn_grants += 1
+                ticket = tickets.popleft()
+                if not tickets:
+                    del self.queues[user]
+                    self.turn_grants = 0
+                return ticket
+            self.queues.move_to_end(user)
+            self.turn_grants = 0
+        return None  # Every waiting user is at its cap
+
+    def dispatch(self):
+        granted = False
+        while self.running < self.slots:
+            if self.interactive:
+                ticket = self.interactive.popleft()
+            elif self.queues and sum(self.batch_running.values()) < self.batch_slots:
+                ticket = self.next_batch_ticket()
+                if ticket is None:
+                    break
+                self.batch_running[ticket["user"]] += 1
+            else:
+                break
+            ticket["granted"] = True
+            self.running += 1
+            granted = True
+        if granted:
+            self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, user, interactive=False):
+        """Hold one API call slot for user, waiting for a fair turn."""
+        ticket = {"user": user, "interactive": interactive, "granted": False}
+        lane = "interactive" if interactive else "batch"
+        metrics = get_metrics()
+        metrics.gauge(f"{lane}_waiting", 1)
+        start = time.perf_counter()
+        with self.cond:
+            if interactive:
+                self.interactive.append(ticket)
+            else:
+                self.queues.setdefault(user, deque()).append(ticket)
+            self.dispatch()
+            while not ticket["granted"]:
+                self.cond.wait()
+        metrics.gauge(f"{lane}_waiting", -1)
+        metrics.incr(f"{lane}_calls")
+        metrics.incr(f"{lane}_wait_s", time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+                if not interactive:
+                    self.batch_running[user] -= 1
+                self.dispatch()
+
+    def snapshot(self):
+        """Per-user batch calls running and waiting, plus the interactive lane."""
+        with self.cond:
+            users = set(self.batch_running) | set(self.queues)
+            rows = [
+                {"User": user, "Running": self.batch_running[user], "Waiting": len(self.queues.get(user, ())),
+                 "Weight": self.weights.get(user, 1)}
+                for user in sorted(users) if self.batch_running[user] or user in self.queues
+            ]
+            return rows, len(self.interactive)
+
+@process_singleton
+def get_scheduler():
+    return FairScheduler(SCHEDULER_SLOTS, SCHEDULER_INTERACTIVE_SLOTS, SCHEDULER_USER_SLOTS, SCHEDULER_WEIGHTS)
+
+# (user, interactive) of the work running in this context. Set by the UI, carried into
+# worker threads by submit_in_context, read by post_chat when it asks for a slot.
+REQUEST_OWNER = contextvars.ContextVar("request_owner", default=None)
+
+def current_user():
+    """Who the current script run belongs to: the proxy's user header, else the browser session."""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return "background"
+    if SCHEDULER_USER_HEADER:
+        user = (_get_websocket_headers() or {}).get(SCHEDULER_USER_HEADER)
+        if user:
+            return user
+    return ctx.session_id
+
+@contextmanager
+def request_lane(interactive):
+    """Run API calls made inside the block, and in threads started with submit_in_context, as this user's."""
+    token = REQUEST_OWNER.set((current_user(), interactive))
+    try:
+        yield
+    finally:
+        REQUEST_OWNER.reset(token)
+
+def submit_in_context(executor, fn, *args):
+    """executor.submit that carries the caller's request owner into the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+class Cassette:
+    """Recorded successful API responses keyed by a fingerprint of the request, zlib-compressed in SQLite."""
+
+    def __init__(self, path=CASSETTE_PATH):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "fingerprint TEXT PRIMARY KEY, status INTEGER, response BLOB, created_at REAL)"
+            )
+
+    @staticmethod
+    def fingerprint(payload):
+        """Which backend served a payload doesn't matter, so routing never changes the fingerprint."""
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, fingerprint):
+        """Return (status_code, response_json) or None if the request was never recorded."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, response FROM responses WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(zlib.decompress(row[1]))
+
+    def put(self, fingerprint, status, response_json):
+        blob = zlib.compress(json.dumps(response_json, separators=(",", ":")).encode("utf-8"), 9)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (fingerprint, status, blob, time.time())
+            )
+
+@process_singleton
+def get_cassette():
+    return Cassette()
+
+def record_reduction(reduction, meta=None):
+    """Account for an image fit_image had to shrink to fit the request."""
+    if reduction is None:
+        return
+    get_metrics().incr("payload_reductions")
+    if meta is not None:
+        meta.setdefault("payload_reductions", []).append(reduction)
+
+def encode_image_to_base64(image_bytes, max_bytes=None, meta=None):
+    if max_bytes is None:
+        return data_url(*encode_image(image_bytes))
+    mime, encoded, reduction = fit_image(image_bytes, max_bytes)
+    record_reduction(reduction, meta)
+    return data_url(mime, encoded)
+
+def image_allowance(payload, images=1):
+    """Bytes each of images data: URLs may take in payload, whose image URLs are still empty."""
+    return (MAX_REQUEST_BYTES - len(request_body(payload))) // max(1, images)
+
+def laplacian(grey):
+    return grey[:-2, 1:-1] + grey[2:, 1:-1] + grey[1:-1, :-2] + grey[1:-1, 2:] - 4 * grey[1:-1, 1:-1]
+
+def assess_quality(image):
+    """Contrast, sharpness, ink coverage and mean brightness of a greyscale PIL image."""
+    grey = np.asarray(image, dtype=np.float32)
+    low, high = np.percentile(grey, (1, 99))
+    spread = max(high - low, 1.0)
+    threshold = (low + high) / 2
+    ink = grey < threshold
+    # Blur is judged only next to ink; the empty sheet would otherwise drown it out
+    near_ink = ink[1:-1, 1:-1] | ink[:-2, 1:-1] | ink[2:, 1:-1] | ink[1:-1, :-2] | ink[1:-1, 2:]
+    edges = laplacian(grey)[near_ink]
+    return {
+        "contrast": float(spread / 255),
+        "sharpness": float(edges.var() / spread ** 2) if edges.size else 0.0,
+        "ink": float(ink.mean()),
+        "threshold": float(threshold),
+        "brightness": float(grey.mean() / 255),
+    }
+
+def quality_problem(report):
+    # Blur first: it smears ink into grey, so a blurred scan also looks dark. A sheet
+    # without ink has no edges to judge.
+    if report["ink"] >= QUALITY_INK_RANGE[0] and report["sharpness"] < QUALITY_MIN_SHARPNESS:
+        return f"too blurred to read (sharpness {report['sharpness']:.4f})"
+    # Even the brightest pixels are dark: a photocopy with the toner turned up, or an all-black page
+    if report["threshold"] < 96 or report["ink"] > QUALITY_INK_RANGE[1]:
+        return f"too dark (mean brightness {report['brightness']:.0%})"
+    if report["ink"] < QUALITY_INK_RANGE[0]:
+        return f"blank page ({report['ink']:.2%} ink coverage)"
+    if report["contrast"] < QUALITY_MIN_CONTRAST:
+        return f"contrast too low ({report['contrast']:.0%} grey range)"
+    return None
+
+def quality_gate(image_bytes, meta=None):
+    """Check a drawing before it is sent. Returns the preprocessed bytes to send, or an error string.
+
+    With QUALITY_GATE off the check is skipped, but the drawing is still preprocessed.
+    """
+    try:
+        if QUALITY_GATE:
+            report = assess_quality(load_working_image(image_bytes, QUALITY_ANALYSIS_SIDE).convert("L"))
+            problem = quality_problem(report)
+            if meta is not None:
+                meta["quality"] = {**report, "problem": problem}
+            if problem is not None:
+                get_metrics().incr("quality_rejects")
+                logger.info("quality gate rejected drawing: %s", problem)
+                return f"❌ Processing Error: rejected by quality gate: {problem}"
+        return preprocess_drawing(image_bytes, meta=meta)
+    except DECODE_ERRORS as e:
+        return f"❌ Processing Error: {str(e)}"
+
+@process_singleton
+def get_preprocess_pool():
+    # Spawned, not forked: forking a threaded server can deadlock the child. A spawned
+    # worker re-runs the parent's main script (app.py under Streamlit, or watch.py or
+    # bench.py, which import app) as "__mp_main__", so app.py keeps main() behind its
+    # __name__ check and starts no work at module level. The functions sent to the pool
+    # live in imaging.py and preprocess.py, whose module names are the same whatever the
+    # main script is.
+    return ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+PREPROCESS_POOL_LOCK = threading.Lock()
+
+def submit_to_preprocess_pool(fn, *args):
+    """get_preprocess_pool().submit, replacing the pool first if a worker died and broke it.
+
+    A pool whose worker was killed (out of memory, a crashing decoder) refuses all
+    further work, so without this every later drawing would fail too.
+    """
+    pool = get_preprocess_pool()
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        with PREPROCESS_POOL_LOCK:
+            if get_preprocess_pool() is pool:  # Not already replaced by another thread
+                logger.warning("preprocessing pool broken by a dead worker; starting a new one")
+                get_metrics().incr("preprocess_pool_restarts")
+                get_preprocess_pool.clear()
+                pool.shutdown(wait=False)
+        return get_preprocess_pool().submit(fn, *args)
+
+@process_singleton
+def get_preprocess_cache():
+    return ArtifactStore(PREPROCESS_CACHE_DIR, PREPROCESS_CACHE_BYTES, PREPROCESS_CACHE_BYTES)
+
+def preprocess_drawing(image_bytes, stages=PREPROCESS_STAGES, meta=None):
+    """Run the preprocessing stages in the process pool. Returns the bytes to send.
+
+    Each stage's output is cached under a key chaining the input's content hash
+    with the stages so far, each with its settings and PREPROCESS_VERSION, so a
+    rerun, or a pipeline that only appends stages, resumes after the longest
+    cached prefix, and changed settings or stage code miss the cache.
+    """
+    if not stages:
+        return image_bytes
+    metrics = get_metrics()
+    cache = get_preprocess_cache()
+    keys, key = [], content_hash(image_bytes)
+    for stage in stages:
+        params = json.dumps(STAGE_PARAMS.get(stage, {}), sort_keys=True)
+        key = content_hash(f"{key}:{stage}:{params}:{PREPROCESS_VERSION}".encode())
+        keys.append(key)
+
+    current, applied, done = image_bytes, [], 0
+    for stage, key in zip(stages, keys):
+        cached = cache.get("preprocess", key)
+        if cached is None:
+            break
+        if len(cached) > 1:  # A single byte marks "stage changed nothing"
+            current = cached[:]
+            applied.append(stage)
+        done += 1
+    metrics.incr("preprocess_cache_hits", done)
+
+    if done < len(stages):
+        image = load_working_image(current)
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        try:
+            outputs = submit_to_preprocess_pool(run_stages, image, stages[done:]).result()
+        except BrokenProcessPool:  # The worker died on this drawing; send it without the remaining stages
+            logger.warning("preprocessing worker died; sending the drawing without %s", ", ".join(stages[done:]))
+            metrics.incr("preprocess_failures")
+            outputs = []
+        for stage, key, output in zip(stages[done:], keys[done:], outputs):
+            cache.put("preprocess", output or b"=", key=key)
+            if output is not None:
+                current = output
+                applied.append(stage)
+                metrics.incr(f"preprocess_{stage}")
+
+    if meta is not None:
+        meta["preprocess"] = {"applied": applied, "cached_stages": done}
+    return current
+
+def clean_value(value):
+    value = value.strip(" \t*_,")
+    if len(value) > 1 and value[0] == value[-1] and value[0] in QUOTES:
+        value = value[1:-1].strip()
+    return "" if len(value) <= 13 and value.upper() in EMPTY_VALUES else value
+
+def learn_spelling(aliases, key):
+    """Field a reply key spelling maps to, "" for a key of no field, None for text that is no key.
+
+    The answer is remembered in aliases, so the next reply using this spelling finds it directly.
+    """
+    if not key or len(key) > 80:
+        return None  # A colon inside a sentence
+    field = aliases.get(normalize_key(key)) or ""
+    if len(aliases) < ALIAS_TABLE_MAX:
+        aliases[key] = field
+    return field
+
+def parse_ai_response(response_text, schema=None, unmatched=None):
+    """Parse the AI response into {field: value}. If a value is missing, return 'Manual Identification Required'.
+
+    Key variants ("Bore Dia", "- **BORE DIAMETER (MM)**") map to the schema's field
+    names, or to any schema's when none is given. A value may continue on the
+    following lines when it starts empty or the lines are indented. Keys that
+    match no field are left out and appended to unmatched, if given, so the
+    caller can count them.
+    """
+    if schema is not None:
+        aliases, known = schema.aliases, schema.parsed_lines
+    else:
+        aliases, known = ALL_FIELD_ALIASES, ALL_FIELD_PARSED_LINES
     results = {}
-    lines = response_text.split('\n')
-    for line in lines:
-        if ':' in line:
-            key, value = line.split(':', 1)
-            key = key.strip().upper()
-            value = value.strip()
-            results[key] = value if value else "Manual Identification Required" 
+    field = None
+    for line in response_text.split("\n"):
+        if ":" in line:
+            # Field lines repeat across a job's drawings ("BORE DIAMETER: 50 MM"), so each is parsed once
+            parsed = known.get(line)
+            if parsed is not None:
+                field, value = parsed
+                if value is not MANUAL_VALUE or field not in results:
+                    results[field] = value
+                continue
+            key, _, value = line.partition(":")
+            # Field names, and spellings met in earlier replies, are a single dict hit
+            try:
+                matched = aliases[key]
+            except KeyError:
+                matched = learn_spelling(aliases, key)
+            if matched:
+                field = matched
+                value = value.strip(" \t*_,")
+                if value and value[0] in VALUE_CHECK_FIRST:
+                    value = clean_value(value)
+                value = value or MANUAL_VALUE
+                if len(known) < PARSED_LINES_MAX:
+                    known[line] = (field, value)
+                if value is not MANUAL_VALUE or field not in results:
+                    results[field] = value
+                continue
+            if matched is not None:
+                field = None
+                if unmatched is not None:
+                    unmatched.append(KEY_BULLET.sub("", key).strip(" \t*_\"'"))
+                continue
+        if field is not None and line and (line[0] in " \t" or results[field] is MANUAL_VALUE):
+            extra = line.strip(" \t*_,")
+            if extra and extra[0] in VALUE_CHECK_FIRST:
+                extra = "" if extra.startswith("```") else clean_value(extra)
+            if extra:
+                current = results[field]
+                results[field] = extra if current is MANUAL_VALUE else f"{current} {extra}"
     return results
 
-def analyze_cylinder_image(image_bytes):
-    base64_image = encode_image_to_base64(image_bytes)
-    
-    payload = {
-        "model": "qwen/qwen2.5-vl-72b-instruct:free",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": (
-                            "Analyze the engineering drawing and extract only the values that are clearly visible in the image.\n"
-                            "STRICT RULES:\n"
-                            "1) If a value is missing or unclear, return an empty string. DO NOT estimate any values.\n"
-                            "2) Convert values to the specified units where applicable.\n"
-                            "3) Determine whether the cylinder is SINGLE-ACTION or DOUBLE-ACTION and set it under CYLINDER ACTION.\n"
-                            "4) Extract and return data in this format:\n"
-                            "CYLINDER ACTION: [value]\n"
-                            "BORE DIAMETER: [value] MM\n"
-                            "OUTSIDE DIAMETER: \n"
-                            "ROD DIAMETER: [value] MM\n"
-                            "STROKE LENGTH: [value] MM\n"
-                            "CLOSE LENGTH: [value] MM\n"
-                            "OPEN LENGTH: \n"
-                            "OPERATING PRESSURE: [value] BAR\n"
-                            "OPERATING TEMPERATURE: [value] DEG C\n"
-                            "MOUNTING: \n"
-                            "ROD END: \n"
-                            "FLUID: [Determine and Extract] \n"
-                            "DRAWING NUMBER: [Extract from Image]"
-                        )
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": base64_image
-                    }
-                ]
-            }
-        ]
-    }
+def parse_reply(reply, schema):
+    """parse_ai_response for a model reply, counting its keys of no field in the metrics."""
+    unmatched = []
+    results = parse_ai_response(reply, schema, unmatched)
+    if unmatched:
+        get_metrics().incr("unmatched_keys", len(unmatched))
+    return results
 
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
+def build_messages(base64_image, model=MODEL, fields=None, schema=DEFAULT_SCHEMA):
+    """Stable system prompt first so providers can cache it; the user turn only carries the image.
+
+    fields narrows the request to the parameters that are still unresolved.
+    """
+    system_content = {"type": "text", "text": schema.system_prompt}
+    if model.startswith(PROMPT_CACHE_MODEL_PREFIXES):
+        system_content["cache_control"] = {"type": "ephemeral"}
+
+    return [
+        {
+            "role": "system",
+            "content": [system_content]
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": USER_PROMPT if not fields else f"{USER_PROMPT} Only these fields are needed: {', '.join(fields)}."
+                },
+                {
+                    "type": "image_url",
+                    "image_url": base64_image
+                }
+            ]
+        }
+    ]
+
+@process_singleton
+def get_backends():
+    return [build_backend(name) for name in BACKENDS]
+
+@process_singleton
+def get_hedge_backend():
+    return OpenRouterBackend("hedge", HEDGE_API_URL, HEDGE_API_KEY, streaming=True, json_mode=True, multi_image=True)
 
+def supports_multi_image():
+    return any(backend.multi_image for backend in get_backends())
+
+def post_chat(payload, meta=None, backend=None):
+    """Send a chat-completions payload and return the reply text or an error string.
+
+    Without a backend, route() picks one of BACKENDS that can serve the payload.
+    """
+    metrics = get_metrics()
+    if backend is None:
+        backend = route(get_backends(), payload)
+        if backend is None:
+            metrics.incr("api_errors")
+            return "❌ API Error: none of the configured BACKENDS can serve this request"
+    cassette = get_cassette() if CASSETTE_MODE != "off" else None
+    fingerprint = Cassette.fingerprint(payload) if cassette else None
+
+    recorded = cassette.get(fingerprint) if CASSETTE_MODE in ("replay", "auto") else None
+    if recorded is None and CASSETTE_MODE == "replay":
+        return f"❌ Processing Error: no recorded response for request {fingerprint[:12]}"
+    if recorded is not None:
+        metrics.incr("cassette_hits")
+    else:
+        metrics.incr("api_calls")
     try:
-        response = requests.post(API_URL, headers=headers, json=payload)
-        response_json = response.json()
+        if recorded is not None:
+            status_code, response_json = recorded
+        else:
+            user, interactive = REQUEST_OWNER.get() or (current_user(), False)
+            with get_scheduler().slot(user, interactive):
+                start = time.perf_counter()  # Latency excludes the wait for a slot
+                metrics.gauge("in_flight", 1)
+                try:
+                    status_code, response_json = backend.complete(payload, MAX_REQUEST_BYTES)
+                except RequestTooLarge as e:
+                    metrics.incr("api_errors")
+                    return f"❌ API Error: {str(e)}; not sent"
+                finally:
+                    metrics.gauge("in_flight", -1)
+            metrics.incr(f"backend_calls_{backend.name}")
+            # Rate limits and server errors are transient; replaying them would fail the run for good
+            if cassette is not None and status_code == 200 and "choices" in response_json:
+                cassette.put(fingerprint, status_code, response_json)
+            record_usage(metrics, response_json.get("usage") or {})
         
-        if response.status_code == 200 and "choices" in response_json:
-            return response_json["choices"][0]["message"]["content"]
+        if meta is not None:
+            meta["usage"] = response_json.get("usage", {})
+            meta["backend"] = backend.name
+
+        if status_code == 200 and "choices" in response_json:
+            if recorded is None:
+                metrics.observe_latency(time.perf_counter() - start)
+            reply = response_json["choices"][0]["message"]["content"]
+            if meta is not None:
+                meta["reply"] = reply
+            return reply
         else:
+            metrics.incr("api_errors")
             return f"❌ API Error: {response_json}"  # Returns error details
 
     except Exception as e:
+        metrics.incr("api_errors")
+        return f"❌ API Error: {str(e)}"  # Connection failures and timeouts
+
+def record_usage(metrics, usage):
+    metrics.incr("prompt_tokens", usage.get("prompt_tokens") or 0)
+    metrics.incr("completion_tokens", usage.get("completion_tokens") or 0)
+    metrics.incr("cached_tokens", (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0)
+    metrics.incr("cost_usd", usage.get("cost") or 0)
+
+def record_drawing(result):
+    """Count a finished drawing for throughput; error strings count as failures."""
+    failed = isinstance(result, str) and result.startswith("❌")
+    get_metrics().incr("drawing_errors" if failed else "drawings")
+    return result
+
+def hedge_deadline(metrics):
+    deadline = metrics.latency_percentile(HEDGE_PERCENTILE)
+    if deadline is None or len(metrics.latencies) < 20:
+        return HEDGE_DEFAULT_DEADLINE
+    return max(HEDGE_MIN_DEADLINE, deadline)
+
+def post_chat_hedged(payload, meta=None, is_valid=None):
+    """post_chat with a backup request when the primary is slower than usual.
+
+    The first reply that is not an error and passes is_valid wins; the loser is
+    abandoned (an in-flight HTTP request can't be cancelled, only ignored).
+    """
+    if not HEDGE_ENABLED:
+        return post_chat(payload, meta)
+
+    metrics = get_metrics()
+    executor = get_hedge_executor()
+    is_good = lambda reply: not reply.startswith("❌") and (is_valid is None or is_valid(reply))
+
+    start = time.perf_counter()
+    primary_meta, backup_meta = {}, {}
+    primary = submit_in_context(executor, post_chat, payload, primary_meta)
+    done, _ = wait([primary], timeout=hedge_deadline(metrics))
+    with metrics.lock:
+        calls = metrics.counters["api_calls"]
+        hedge_allowed = metrics.counters["hedged_calls"] < HEDGE_MAX_RATE * (calls - metrics.counters["hedged_calls"])
+    if done or not hedge_allowed:
+        reply = primary.result()
+        if meta is not None:
+            meta.update(primary_meta)
+        return reply
+
+    metrics.incr("hedged_calls")
+    metrics.incr("retries")
+    backup = submit_in_context(
+        executor, post_chat, {**payload, "model": HEDGE_MODEL}, backup_meta, get_hedge_backend()
+    )
+    pending = {primary, backup}
+    first_reply = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            reply = future.result()
+            first_reply = first_reply or reply
+            if not is_good(reply):
+                continue
+            for other in pending:
+                other.cancel()
+            if future is backup:
+                won_at = time.perf_counter() - start
+                metrics.incr("hedge_wins")
+                # Savings are known once the abandoned primary finally returns
+                primary.add_done_callback(
+                    lambda _: metrics.incr("hedge_saved_s", time.perf_counter() - start - won_at)
+                )
+            if meta is not None:
+                meta.update(backup_meta if future is backup else primary_meta)
+                meta["hedged"] = True
+                meta["hedge_winner"] = "backup" if future is backup else "primary"
+            return reply
+    return first_reply
+
+def request_skeleton(model=MODEL, count=1, schema=DEFAULT_SCHEMA, fields=None):
+    """The payload for count drawings with their image URLs still empty, for sizing them with image_allowance."""
+    return {
+        "model": model,
+        "messages": (
+            build_messages("", model, fields, schema) if count == 1
+            else build_batch_messages([""] * count, model, schema)
+        ),
+        "usage": {"include": True}  # Ask OpenRouter for token and cache accounting
+    }
+
+def analyze_cylinder_image(image_bytes, model=MODEL, meta=None, temperature=None, fields=None, schema=DEFAULT_SCHEMA,
+                           image_url=None):
+    payload = request_skeleton(model, 1, schema, fields)
+    if image_url is None:  # Otherwise the request pipeline has already encoded the drawing
+        try:
+            image_url = encode_image_to_base64(image_bytes, image_allowance(payload), meta)
+        except DECODE_ERRORS as e:  # Unreadable, over the decode budget, or too large to send
+            return f"❌ Processing Error: {str(e)}"
+    payload["messages"] = build_messages(image_url, model, fields, schema)
+    if temperature is not None:
+        payload["temperature"] = temperature
+    return post_chat_hedged(payload, meta, lambda reply: not parse_ai_response(reply, schema).keys().isdisjoint(schema.fields))
+
+def is_low_confidence(parsed_results, schema=DEFAULT_SCHEMA):
+    """Flag drawings with many missing fields or values that fail the schema's validation rules."""
+    missing = sum(1 for k in schema.fields if parsed_results.get(k, MANUAL_VALUE) in ("", MANUAL_VALUE))
+    return missing >= LOW_CONFIDENCE_MISSING_FIELDS or bool(schema.validate(parsed_results))
+
+def normalize_vote(value):
+    if value in ("", MANUAL_VALUE):
+        return ""
+    return re.sub(r"\s+", "", value.upper())
+
+def vote_fields(samples, schema=DEFAULT_SCHEMA):
+    """Majority-vote each parameter across parsed samples.
+
+    Returns {parameter: (value, confidence)} where confidence is the winning share of votes.
+    """
+    voted = {}
+    for key in schema.fields:
+        votes = Counter()
+        first_seen = {}
+        for sample in samples:
+            value = sample.get(key, MANUAL_VALUE)
+            normalized = normalize_vote(value)
+            votes[normalized] += 1
+            first_seen.setdefault(normalized, value)
+        winner, count = votes.most_common(1)[0]
+        voted[key] = (first_seen[winner] if winner else MANUAL_VALUE, count / len(samples))
+    return voted
+
+def analyze_with_voting(image_bytes, first_result=None, samples=VOTING_SAMPLES, schema=DEFAULT_SCHEMA):
+    """Draw extra samples concurrently and vote; first_result (already parsed) counts as one sample.
+
+    Returns the voted {parameter: (value, confidence)} or None if every sample failed.
+    """
+    configs = [(m, t) for t in VOTING_TEMPERATURES for m in VOTING_MODELS]
+    needed = samples - (1 if first_result is not None else 0)
+    configs = [configs[i % len(configs)] for i in range(needed)]
+
+    parsed = [first_result] if first_result is not None else []
+    with ThreadPoolExecutor(max_workers=max(1, len(configs))) as executor:
+        futures = [
+            submit_in_context(executor, analyze_cylinder_image, image_bytes, model, None, temperature, None, schema)
+            for model, temperature in configs
+        ]
+        for future in futures:
+            reply = future.result()
+            if not reply.startswith("❌"):
+                parsed.append(parse_reply(reply, schema))
+
+    return vote_fields(parsed, schema) if parsed else None
+
+def image_to_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+def add_usage(total, usage):
+    for key in ("prompt_tokens", "completion_tokens", "total_tokens", "cost"):
+        if usage.get(key):
+            total[key] = total.get(key, 0) + usage[key]
+
+def unresolved_fields(results, schema=DEFAULT_SCHEMA):
+    problems = schema.validate(results)
+    return [k for k in schema.fields if results.get(k, MANUAL_VALUE) in ("", MANUAL_VALUE) or k in problems]
+
+def analyze_adaptive(image_bytes, model=MODEL, meta=None, schema=DEFAULT_SCHEMA):
+    """Climb the resolution ladder until the extraction validates. Returns parsed results or an error string.
+
+    Each rung only asks for the fields still unresolved; earlier good values are kept.
+    """
+    metrics = get_metrics()
+    try:
+        image = load_working_image(image_bytes)
+    except DECODE_ERRORS as e:
+        return f"❌ Processing Error: {str(e)}"
+    results, fields, usage, rungs = {}, None, {}, []
+
+    def run_rung(label, rung_image, fields):
+        call_meta = {}
+        reply = analyze_cylinder_image(image_to_png(rung_image), model, call_meta, fields=fields, schema=schema)
+        add_usage(usage, call_meta.get("usage") or {})
+        if rungs:
+            metrics.incr("retries")
+        rungs.append(label)
+        metrics.incr(f"ladder_calls_{label}")
+        if reply.startswith("❌"):
+            return reply
+        unresolved = set(unresolved_fields(results, schema))
+        for key, value in parse_reply(reply, schema).items():
+            if key in schema.fields and (key not in results or key in unresolved):
+                results[key] = value
+        return None
+
+    previous_side = None
+    for rung in RESOLUTION_LADDER:
+        side = min(rung or max(image.size), max(image.size))
+        if side == previous_side:
+            continue  # Small drawings reach full resolution early
+        previous_side = side
+        rung_image = image.copy()
+        rung_image.thumbnail((side, side))
+        error = run_rung(f"{rung}px" if side == rung else "full", rung_image, fields)
+        if error and not results:
+            return error
+        fields = unresolved_fields(results, schema)
+        missing = [k for k in schema.fields if results.get(k, MANUAL_VALUE) in ("", MANUAL_VALUE)]
+        if not schema.validate(results) and len(missing) < ADAPTIVE_MISSING_FIELDS:
+            break
+
+    crop_fields = [k for k in TITLE_BLOCK_FIELDS if k in fields and k in schema.fields]
+    if crop_fields:
+        width, height = image.size
+        left, top, right, bottom = TITLE_BLOCK_BOX
+        crop = image.crop((int(left * width), int(top * height), int(right * width), int(bottom * height)))
+        run_rung("title-block", crop, crop_fields)
+
+    unresolved = unresolved_fields(results, schema)
+    metrics.incr(f"ladder_final_{rungs[-1]}")
+    if unresolved:
+        metrics.incr("ladder_unresolved")
+    logger.info(
+        "adaptive resolution: %s (%d calls, %d fields unresolved)", " -> ".join(rungs), len(rungs), len(unresolved)
+    )
+    if meta is not None:
+        meta["usage"] = usage
+        meta["resolution_ladder"] = rungs
+    return results
+
+def estimate_image_tokens(width, height):
+    # Qwen2.5-VL spends one token per 28x28 patch and caps an image at 16384 tokens
+    return min(16384, max(4, (width // 28) * (height // 28)))
+
+def plan_batches(images, model=MODEL, schema=DEFAULT_SCHEMA):
+    """Group (name, image_bytes) pairs into batches that fit the model's context window.
+
+    Large sheets always go alone; small ones are packed greedily up to MAX_BATCH_SIZE.
+    """
+    budget = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS) - len(schema.system_prompt) // 4
+    batches, current, used = [], [], 0
+    for name, image_bytes in images:
+        width, height = Image.open(io.BytesIO(image_bytes)).size  # Header only, no decode
+        if width * height > BATCH_MAX_PIXELS:
+            batches.append([(name, image_bytes)])
+            continue
+        cost = estimate_image_tokens(width, height) + RESPONSE_TOKENS_PER_DRAWING
+        if current and (len(current) >= MAX_BATCH_SIZE or used + cost > budget):
+            batches.append(current)
+            current, used = [], 0
+        current.append((name, image_bytes))
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+def estimate_request_tokens(images, schema=DEFAULT_SCHEMA):
+    """Upper-bound token estimate for one request from image headers and prompt length."""
+    tokens = (len(schema.system_prompt) + len(USER_PROMPT)) // 4
+    for image_bytes in images:
+        width, height = Image.open(io.BytesIO(image_bytes)).size  # Header only, no decode
+        tokens += estimate_image_tokens(width, height) + RESPONSE_TOKENS_PER_DRAWING
+    return tokens
+
+class BudgetGovernor:
+    """Admits requests against the process-wide hourly budget and one batch run's budget.
+
+    Requests go out as asked until either budget passes BUDGET_DOWNGRADE_AT; then
+    they use BUDGET_FALLBACK_MODEL with images reduced to BUDGET_FALLBACK_MAX_SIDE.
+    A request that still doesn't fit waits for the hourly window (up to
+    BUDGET_MAX_WAIT) or fails once the batch budget is spent.
+    """
+
+    def __init__(self, batch_limit=BATCH_TOKEN_BUDGET):
+        self.hourly = get_hourly_budget()
+        self.batch = TokenBudget(batch_limit)
+        self.downgrades = 0
+
+    def admit(self, images, model=MODEL, schema=DEFAULT_SCHEMA):
+        """Returns (model, images, estimate) to send, or an error string."""
+        metrics = get_metrics()
+        try:
+            estimate = estimate_request_tokens(images, schema)
+            if max(self.hourly.used_fraction(estimate), self.batch.used_fraction(estimate)) >= BUDGET_DOWNGRADE_AT:
+                model = BUDGET_FALLBACK_MODEL
+                images = [image_to_png(load_working_image(b, BUDGET_FALLBACK_MAX_SIDE)) for b in images]
+                estimate = estimate_request_tokens(images, schema)
+                self.downgrades += 1
+                metrics.incr("budget_downgrades")
+        except (OSError, ValueError) as e:
+            return f"❌ Processing Error: {str(e)}"
+
+        if not self.batch.reserve(estimate):
+            return f"❌ Budget Error: batch token budget of {self.batch.limit} exhausted"
+        if self.hourly.used_fraction(estimate) > 1:
+            metrics.incr("budget_waits")
+        if not self.hourly.reserve(estimate, BUDGET_MAX_WAIT):
+            self.batch.settle(estimate, 0)
+            return f"❌ Budget Error: hourly token budget of {self.hourly.limit} still full after {BUDGET_MAX_WAIT:.0f}s"
+        return model, images, estimate
+
+    def settle(self, estimate, usage):
+        # Replays and failed calls without usage are charged at the estimate
+        actual = usage.get("total_tokens") or (usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0))
+        for budget in (self.hourly, self.batch):
+            budget.settle(estimate, actual or estimate)
+
+def run_within_budget(governor, images, model, schema, meta, send):
+    """Call send(model, images, meta) with the governor's choice of model and images."""
+    if governor is None:
+        return send(model, images, meta)
+    admitted = governor.admit(images, model, schema)
+    if isinstance(admitted, str):
+        return admitted
+    model, images, estimate = admitted
+    call_meta = {}
+    try:
+        return send(model, images, call_meta)
+    finally:
+        governor.settle(estimate, call_meta.get("usage") or {})
+        if meta is not None:
+            meta.update(call_meta)
+
+def build_batch_messages(base64_images, model=MODEL, schema=DEFAULT_SCHEMA):
+    messages = build_messages(None, model, schema=schema)
+    content = [{
+        "type": "text",
+        "text": (
+            f"You are given {len(base64_images)} separate drawings labelled DRAWING 1 to DRAWING {len(base64_images)}.\n"
+            "Return ONLY a JSON array with one object per drawing, in the same order. "
+            "Each object must use exactly these keys: " + ", ".join(schema.fields) + ". "
+            "Use an empty string for any value that is missing or unclear."
+        )
+    }]
+    for i, base64_image in enumerate(base64_images, start=1):
+        content.append({"type": "text", "text": f"DRAWING {i}:"})
+        content.append({"type": "image_url", "image_url": base64_image})
+    messages[1]["content"] = content
+    return messages
+
+def parse_batch_response(response_text, count, schema=DEFAULT_SCHEMA):
+    """Demultiplex a JSON array reply into one parsed dict per drawing, or None if it doesn't line up.
+
+    Keys and values are normalised as parse_ai_response does, so a drawing gives the
+    same fields whether or not it shared a request.
+    """
+    start, end = response_text.find("["), response_text.rfind("]")
+    if start == -1 or end < start:
+        return None
+    try:
+        items = json.loads(response_text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(items, list) or len(items) != count or not all(isinstance(i, dict) for i in items):
+        return None
+
+    results, unmatched = [], 0
+    for item in items:
+        parsed = {}
+        for key, value in item.items():
+            key = str(key)
+            field = schema.aliases.get(key)
+            if field is None:
+                field = learn_spelling(schema.aliases, key)
+            if not field:
+                unmatched += 1
+                continue
+            value = clean_value(str(value) if value is not None else "")
+            if value:
+                parsed[field] = value
+            elif field not in parsed:
+                parsed[field] = MANUAL_VALUE
+        results.append(parsed)
+    if unmatched:
+        get_metrics().incr("unmatched_keys", unmatched)
+    return results
+
+def run_pipeline(jobs, allowance, send, io_workers=PIPELINE_IO_WORKERS, depth=PIPELINE_QUEUE_DEPTH):
+    """Encode requests in the process pool and send them from I/O threads, the two stages overlapping.
+
+    jobs are (key, image bytes list); allowance(images) is each image's share of the
+    request. send(key, images, encoded) runs on an I/O thread with the encode_data_urls
+    output, an error string, or None if a pool worker died and the images are still
+    to be encoded. The bounded queue between the stages is the backpressure:
+    encoding stays at most a pool's width ahead of a full queue, which bounds memory.
+    """
+    metrics = get_metrics()
+    ready = queue.Queue(maxsize=depth)
+
+    def consume():
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            metrics.gauge("encoded_waiting", -1)
+            try:
+                send(*item)
+            except Exception:
+                logger.exception("request pipeline: sending %r failed", item[0])
+
+    def collect(key, images, future):
+        try:
+            encoded = future.result()
+        except BrokenProcessPool:  # The next submit replaces the pool
+            encoded = None
+        except Exception as e:  # Over the decode budget, or too large to send
+            encoded = f"❌ Processing Error: {str(e)}"
+        metrics.gauge("encoded_waiting", 1)
+        ready.put((key, images, encoded))  # Blocks while the I/O stage is behind
+
+    with ThreadPoolExecutor(max_workers=io_workers) as executor:
+        consumers = [submit_in_context(executor, consume) for _ in range(io_workers)]
+        try:
+            pending = deque()
+            for key, images in jobs:
+                pending.append((key, images, submit_to_preprocess_pool(encode_data_urls, images, allowance(images))))
+                if len(pending) >= PREPROCESS_WORKERS:  # Enough to keep every worker busy
+                    collect(*pending.popleft())
+            while pending:
+                collect(*pending.popleft())
+        finally:
+            for _ in consumers:
+                ready.put(None)
+
+def analyze_cylinder_batch(images, model=MODEL, meta=None, schema=DEFAULT_SCHEMA, on_result=None, governor=None,
+                           pack=True):
+    """Analyze several drawings; returns {name: parsed results or error string}.
+
+    Requests go through run_pipeline, several in flight at once. pack=False sends
+    every drawing alone. Batches that come back malformed are retried one drawing
+    per request. on_result(name, result) is called from the I/O threads as each
+    drawing finishes.
+    """
+    results = {}
+    def finish(name, result):
+        results[name] = record_drawing(result)
+        if on_result is not None:
+            on_result(name, result)
+
+    def send_job(batch, planned, encoded):
+        def pipelined_urls(batch_images, call_meta):
+            # A budget downgrade swaps in smaller images, which are encoded on the spot instead,
+            # as are images the pool failed on
+            if batch_images is not planned or not isinstance(encoded, list):
+                return None
+            for _, reduction in encoded:
+                record_reduction(reduction, call_meta)
+            return [url for url, _ in encoded]
+
+        def send_batch(model, batch_images, call_meta):
+            payload = request_skeleton(model, len(batch_images), schema)
+            urls = pipelined_urls(batch_images, call_meta)
+            if urls is None:
+                allowance = image_allowance(payload, len(batch_images))  # An even share of the request per drawing
+                try:
+                    urls = [encode_image_to_base64(b, allowance, call_meta) for b in batch_images]
+                except DECODE_ERRORS as e:
+                    return f"❌ Processing Error: {str(e)}"
+            payload["messages"] = build_batch_messages(urls, model, schema)
+            return post_chat(payload, call_meta)
+
+        def send_one(model, single, call_meta):
+            urls = pipelined_urls(single, call_meta)
+            return analyze_cylinder_image(single[0], model, call_meta, schema=schema, image_url=urls and urls[0])
+
+        if len(batch) == 1:
+            name = batch[0][0]
+            if isinstance(encoded, str):
+                finish(name, encoded)
+                return
+            reply = run_within_budget(governor, planned, model, schema, meta, send_one)
+            finish(name, reply if reply.startswith("❌") else parse_reply(reply, schema))
+            return
+
+        # Drawings that could not share a request within the size limit go one by one,
+        # where each gets the whole limit
+        if not isinstance(encoded, str):
+            reply = run_within_budget(governor, planned, model, schema, meta, send_batch)
+            if reply.startswith("❌ Budget Error"):
+                for name, _ in batch:
+                    finish(name, reply)
+                return
+            parsed = None if reply.startswith("❌") else parse_batch_response(reply, len(batch), schema)
+            if parsed is not None:
+                for (name, _), item in zip(batch, parsed):
+                    finish(name, item)
+                return
+        get_metrics().incr("retries", len(batch))
+        for name, image_bytes in batch:
+            reply = run_within_budget(governor, [image_bytes], model, schema, meta, send_one)
+            finish(name, reply if reply.startswith("❌") else parse_reply(reply, schema))
+
+    batches = plan_batches(images, model, schema) if pack and supports_multi_image() else [[item] for item in images]
+    run_pipeline(
+        [(batch, [b for _, b in batch]) for batch in batches],
+        lambda planned: image_allowance(request_skeleton(model, len(planned), schema), len(planned)),
+        send_job
+    )
+    for name, _ in images:
+        if name not in results:  # send_job raised; run_pipeline has logged why
+            finish(name, "❌ Processing Error: request failed, see the server log")
+    return results
+
+def read_pdf_text_layer(pdf_bytes):
+    """Return the text lines of a PDF's first page as (x0, y0, x1, y1, text), in reading order."""
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        words = doc[0].get_text("words")
+
+    lines = {}
+    for x0, y0, x1, y1, text, block, line, _ in words:
+        if (block, line) in lines:
+            lx0, ly0, lx1, ly1, ltext = lines[(block, line)]
+            lines[(block, line)] = (min(lx0, x0), min(ly0, y0), max(lx1, x1), max(ly1, y1), f"{ltext} {text}")
+        else:
+            lines[(block, line)] = (x0, y0, x1, y1, text)
+    return sorted(lines.values(), key=lambda l: (round(l[1]), l[0]))
+
+def neighbour_texts(line, lines):
+    """Text to the right on the same row, then text directly below: where title blocks put values."""
+    x0, y0, x1, y1, _ = line
+    height = y1 - y0
+    right = sorted(
+        (l for l in lines if l[0] >= x1 - 1 and abs(l[1] - y0) < height / 2),
+        key=lambda l: l[0]
+    )
+    below = sorted(
+        (l for l in lines if 0 < l[1] - y0 < 3 * height and l[0] < x1 and l[2] > x0),
+        key=lambda l: l[1]
+    )
+    return [l[4] for l in right[:1] + below[:1]]
+
+def extract_text_layer_fields(lines, schema=DEFAULT_SCHEMA):
+    """Pattern-match parameter values out of PDF text lines. Only resolved fields are returned."""
+    fields = {}
+    for line in lines:
+        text = line[4]
+        for field, (label, value, unit) in schema.text_layer.items():
+            if field in fields:
+                continue
+            match = label.search(text)
+            if not match:
+                continue
+            candidates = [text[match.end():]] + neighbour_texts(line, lines)
+            for candidate in candidates:
+                found = value.match(candidate)
+                if found:
+                    number = found.group(1).replace(",", ".")
+                    if unit:
+                        number = convert_unit(number, found.groupdict().get("unit"), unit)
+                    if number is not None:
+                        fields[field] = f"{number} {unit}" if unit else number
+                    break
+    return fields
+
+def unit_key(unit):
+    return re.sub(r"[\s.]", "", unit.upper()).replace("°", "DEG")
+
+def convert_unit(number, written, unit):
+    """number, stated in the written unit, in the schema's unit; None if it can't be converted.
+
+    A missing or unrecognised written unit means the drawing uses the schema's unit.
+    """
+    written, target = unit_key(written or ""), unit_key(unit)
+    if written not in KNOWN_UNITS or written == target:
+        return number
+    factor, offset = UNIT_CONVERSIONS.get(target, {}).get(written, (None, None))
+    if factor is None:
+        return None
+    return f"{round(float(number) * factor + offset, 2):g}"
+
+def render_pdf_page(pdf_bytes, dpi=PDF_RENDER_DPI):
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page = doc[0]
+        # Large sheets (A0 and up) are rendered at a lower dpi to stay inside the decode budget
+        points = page.rect.width * page.rect.height
+        dpi = min(dpi, int(72 * math.sqrt(MAX_DECODE_PIXELS / points)))
+        return page.get_pixmap(dpi=dpi).tobytes("png")
+
+def pdf_prepass(pdf_bytes, schema=DEFAULT_SCHEMA):
+    """Read what we can from the PDF text layer.
+
+    Returns (text_layer_fields, png_bytes); png_bytes is None when the text layer
+    resolved every required field and no VLM call is needed.
+    """
+    if pymupdf is None:
+        raise RuntimeError("PDF support requires PyMuPDF (pip install PyMuPDF)")
+    fields = extract_text_layer_fields(read_pdf_text_layer(pdf_bytes), schema)
+    if all(k in fields for k in schema.text_layer_required):
+        return fields, None
+    return fields, render_pdf_page(pdf_bytes)
+
+def analyze_drawing_pdf(pdf_bytes, model=MODEL, meta=None, schema=DEFAULT_SCHEMA, governor=None):
+    """Text-layer pre-pass, then the VLM only for unresolved fields. Returns parsed results or an error string.
+
+    A governor meters the VLM call on the rendered page, as for image drawings.
+    """
+    try:
+        fields, png_bytes = pdf_prepass(pdf_bytes, schema)
+    except Exception as e:
+        return f"❌ Processing Error: {str(e)}"
+    if png_bytes is None:
+        return fields
+
+    missing = [k for k in schema.fields if k not in fields]
+
+    def send(model, images, call_meta):
+        return analyze_cylinder_image(images[0], model, call_meta, fields=missing, schema=schema)
+    result = run_within_budget(governor, [png_bytes], model, schema, meta, send)
+    if result.startswith("❌"):
+        return result
+    return {**parse_reply(result, schema), **fields}
+
+def is_pdf(data):
+    return data[:5] == b"%PDF-"
+
+def classify_text(text):
+    """Pick the schema whose keywords occur most often in the text; None if nothing matches."""
+    scores = {name: sum(len(k.findall(text)) for k in schema.keywords) for name, schema in SCHEMAS.items()}
+    best = max(scores, key=scores.get)
+    return SCHEMAS[best] if scores[best] else None
+
+def make_thumbnail(image_bytes, max_side=CLASSIFIER_MAX_SIDE):
+    image = load_working_image(image_bytes, max_side)
+    buffer = io.BytesIO()
+    image.convert("L").save(buffer, "PNG")
+    return buffer.getvalue()
+
+def classify_drawing(data):
+    """Decide which schema a drawing needs.
+
+    PDFs are classified from their text layer for free; otherwise a thumbnail goes to
+    CLASSIFIER_MODEL with a one-word question. Falls back to DEFAULT_SCHEMA, also for
+    a file that can't be read, whose extraction then reports the error.
+    """
+    if len(SCHEMAS) == 1:
+        return DEFAULT_SCHEMA
+    try:
+        if is_pdf(data):
+            if pymupdf is None:
+                return DEFAULT_SCHEMA
+            schema = classify_text(" ".join(line[4] for line in read_pdf_text_layer(data)))
+            if schema is not None:
+                return schema
+            data = render_pdf_page(data, dpi=72)
+        thumbnail = encode_image_to_base64(make_thumbnail(data))
+    except Exception as e:  # PyMuPDF raises FileDataError, IndexError, ... for damaged PDFs
+        logger.warning("cannot classify an unreadable drawing: %s", e)
+        return DEFAULT_SCHEMA
+
+    payload = {
+        "model": CLASSIFIER_MODEL,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": "Which component does this engineering drawing show? "
+                            f"Answer with exactly one word from: {', '.join(SCHEMAS)}."
+                },
+                {
+                    "type": "image_url",
+                    "image_url": thumbnail
+                }
+            ]
+        }],
+        "max_tokens": 5,
+        "temperature": 0
+    }
+    reply = post_chat(payload).lower()
+    for name, schema in SCHEMAS.items():
+        if name in reply:
+            return schema
+    return DEFAULT_SCHEMA
+
+def extract_drawing(data, model=MODEL, meta=None, schema=None, governor=None):
+    """Run one drawing (image or PDF) through the pipeline. Returns parsed results or an error string.
+
+    Without a schema the drawing is classified first. A governor meters the
+    extraction call, for a PDF the one on its rendered page if the text layer
+    leaves fields open.
+    """
+    if not is_pdf(data):
+        data = quality_gate(data, meta)  # Before classification, which is an API call too
+        if isinstance(data, str):
+            return record_drawing(data)
+    if schema is None:
+        schema = classify_drawing(data)
+    if meta is not None:
+        meta["schema"] = schema.name
+    if is_pdf(data):
+        return record_drawing(analyze_drawing_pdf(data, model, meta, schema, governor))
+
+    def send(model, images, call_meta):
+        if ADAPTIVE_RESOLUTION:
+            return analyze_adaptive(images[0], model, call_meta, schema)
+        reply = analyze_cylinder_image(images[0], model, call_meta, schema=schema)
+        return reply if reply.startswith("❌") else parse_reply(reply, schema)
+    return record_drawing(run_within_budget(governor, [data], model, schema, meta, send))
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def archive_members(fileobj):
+    """Yield (member path, bytes or error string) for each drawing in a zip or tar archive.
+
+    Members are read one at a time as the caller asks for them: zip entries through
+    ZipFile.open, tars as a stream ("r|*", any compression). Nothing is extracted
+    to disk and only the current member is held in memory.
+    """
+    def wanted(path):
+        return (
+            path.lower().endswith(ARCHIVE_MEMBER_EXTENSIONS)
+            and not path.rsplit("/", 1)[-1].startswith(".")  # macOS "._" resource forks
+            and not path.startswith("__MACOSX/")
+        )
+
+    def read(path, size, stream):
+        if size > ARCHIVE_MAX_MEMBER_BYTES:
+            return f"❌ Processing Error: {path} unpacks to {size / 1024 ** 2:,.1f} MiB, over ARCHIVE_MAX_MEMBER_BYTES"
+        data = stream.read(ARCHIVE_MAX_MEMBER_BYTES + 1)  # The header's size can lie
+        if len(data) > ARCHIVE_MAX_MEMBER_BYTES:
+            return f"❌ Processing Error: {path} unpacks to more than ARCHIVE_MAX_MEMBER_BYTES"
+        return data
+
+    fileobj.seek(0)
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not wanted(info.filename):
+                    continue
+                try:
+                    with archive.open(info) as stream:
+                        data = read(info.filename, info.file_size, stream)
+                except (RuntimeError, zipfile.BadZipFile, NotImplementedError) as e:  # Encrypted, corrupt, odd codec
+                    data = f"❌ Processing Error: {info.filename}: {str(e)}"
+                yield info.filename, data
+        return
+
+    fileobj.seek(0)
+    try:
+        archive = tarfile.open(fileobj=fileobj, mode="r|*")
+    except tarfile.TarError:
+        raise ValueError("not a zip or tar archive")
+    with archive:
+        for member in archive:
+            if member.isfile() and wanted(member.name):
+                yield member.name, read(member.name, member.size, archive.extractfile(member))
+
+def analyze_archive(fileobj, archive_name, schema=None, governor=None, workers=PIPELINE_IO_WORKERS, on_result=None):
+    """Extract every drawing in a zip or tar archive, several at a time.
+
+    Returns (results, schemas, duplicates). Results and schemas are keyed by
+    "<archive name>/<member path>"; duplicates maps each skipped member to the earlier
+    member with the same content. Reading pauses while 2 x workers members are waiting
+    or in flight, which bounds memory. A damaged archive keeps the members extracted
+    before the damage and reports the rest under the archive's own name.
+    on_result(path, result, schema) is called as each member finishes.
+    """
+    metrics = get_metrics()
+    results, schemas, duplicates, first_seen = {}, {}, {}, {}
+
+    def settle(path, result, result_schema=None):
+        results[path] = result
+        if result_schema is not None:
+            schemas[path] = result_schema
+        if on_result is not None:
+            on_result(path, result, result_schema)
+
+    def extract(path, data):
+        meta = {}
+        try:
+            result = extract_drawing(data, schema=schema, meta=meta, governor=governor)
+        except Exception as e:
+            result = record_drawing(f"❌ Processing Error: {str(e)}")
+        return path, result, meta.get("schema")
+
+    def collect(done):
+        for future in done:
+            path, result, schema_name = future.result()
+            settle(path, result, SCHEMAS.get(schema_name, schema or DEFAULT_SCHEMA))
+            metrics.gauge("queue_depth", -1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        try:
+            for member, data in archive_members(fileobj):
+                path = f"{archive_name}/{member}"
+                if isinstance(data, str):
+                    settle(path, record_drawing(data))
+                    continue
+                digest = content_hash(data)
+                if digest in first_seen:
+                    duplicates[path] = first_seen[digest]
+                    metrics.incr("archive_duplicates")
+                    continue
+                first_seen[digest] = path
+                results[path] = None  # Holds the member's place in archive order
+                metrics.incr("archive_members")
+                metrics.gauge("queue_depth", 1)
+                pending.add(submit_in_context(executor, extract, path, data))
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+        except (ValueError, OSError, EOFError, tarfile.TarError, zipfile.BadZipFile) as e:
+            settle(archive_name, record_drawing(f"❌ Processing Error: {archive_name}: {str(e)}"))
+        finally:
+            collect(wait(pending).done)
+    return results, schemas, duplicates
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+class ResultsStore:
+    """Extraction results keyed by the SHA-256 of the drawing file, safe to share between threads."""
+
+    def __init__(self, path=RESULTS_DB):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "content_hash TEXT PRIMARY KEY, source TEXT, drawing_number TEXT, "
+                "results TEXT, created_at REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_drawing ON results (drawing_number)")
+            # Reduced greyscale copies, kept so the next revision can be diffed against them
+            self.conn.execute("CREATE TABLE IF NOT EXISTS images (content_hash TEXT PRIMARY KEY, image BLOB)")
+
+    def has(self, digest):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM results WHERE content_hash = ?", (digest,)).fetchone()
+        return row is not None
+
+    def get(self, digest):
+        with self.lock:
+            row = self.conn.execute("SELECT results FROM results WHERE content_hash = ?", (digest,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, digest, source, parsed_results, image=None):
+        drawing_number = parsed_results.get("DRAWING NUMBER")
+        if drawing_number == MANUAL_VALUE:
+            drawing_number = None
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (digest, source, drawing_number, json.dumps(parsed_results), time.time())
+            )
+            if image is not None:
+                self.conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?)", (digest, image))
+
+    def latest(self, drawing_number, exclude=None):
+        """Most recent stored revision of a drawing number as (results, image or None, source), or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT r.results, i.image, r.source FROM results r LEFT JOIN images i USING (content_hash) "
+                "WHERE r.drawing_number = ? AND r.content_hash != ? ORDER BY r.created_at DESC LIMIT 1",
+                (drawing_number, exclude or "")
+            ).fetchone()
+        return (json.loads(row[0]), row[1], row[2]) if row else None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+@process_singleton
+def get_results_store():
+    return ResultsStore()
+
+def revision_image(data):
+    """Greyscale PNG of a drawing at the size revisions are compared at."""
+    if is_pdf(data):
+        data = render_pdf_page(data)
+    return image_to_png(load_working_image(data, REVISION_MAX_SIDE).convert("L"))
+
+def change_regions(old_png, new_png):
+    """Boxes around areas that differ, in new-image pixels, and the changed share of the sheet.
+
+    The mask is pooled into a coarse grid and touching cells are merged, so one
+    edited dimension becomes one region. Sheets scanned with an offset light up
+    almost everywhere and end up re-extracted in full.
+    """
+    new = Image.open(io.BytesIO(new_png)).convert("L")
+    old = Image.open(io.BytesIO(old_png)).convert("L").resize(new.size)
+    mask = ImageChops.difference(old, new).point(lambda v: 255 if v > REVISION_PIXEL_THRESHOLD else 0)
+    cell = max(1, math.ceil(max(new.size) / REVISION_GRID))
+    cols, rows = math.ceil(new.width / cell), math.ceil(new.height / cell)
+    grid = mask.resize((cols, rows), Image.BOX)  # Non-zero once about 1/500 of a cell's pixels changed
+    changed = {(x, y) for y in range(rows) for x in range(cols) if grid.getpixel((x, y))}
+
+    regions, remaining = [], set(changed)
+    while remaining:
+        stack = [remaining.pop()]
+        xs, ys = [], []
+        while stack:
+            x, y = stack.pop()
+            xs.append(x)
+            ys.append(y)
+            for neighbour in ((x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+                if neighbour in remaining:
+                    remaining.remove(neighbour)
+                    stack.append(neighbour)
+        # One cell of margin so labels next to a changed value are in the crop
+        regions.append((
+            max(0, (min(xs) - 1) * cell), max(0, (min(ys) - 1) * cell),
+            min(new.width, (max(xs) + 2) * cell), min(new.height, (max(ys) + 2) * cell)
+        ))
+    return regions, len(changed) / (cols * rows)
+
+def read_drawing_number(revision_png, model=MODEL, meta=None, schema=DEFAULT_SCHEMA):
+    image = Image.open(io.BytesIO(revision_png))
+    left, top, right, bottom = TITLE_BLOCK_BOX
+    crop = image.crop((int(left * image.width), int(top * image.height), image.width, image.height))
+    reply = analyze_cylinder_image(image_to_png(crop), model, meta, fields=["DRAWING NUMBER"], schema=schema)
+    value = "" if reply.startswith("❌") else parse_ai_response(reply, schema).get("DRAWING NUMBER", "")
+    return None if value in ("", MANUAL_VALUE) else value
+
+def analyze_revision(data, store, source, model=MODEL, meta=None, schema=None, drawing_number=None):
+    """Extract a drawing, reusing the stored extraction of its previous revision where the sheet is unchanged.
+
+    Returns a dict with the merged results, the previous results, the changed
+    regions and how the revision was handled ("baseline", "unchanged",
+    "regions" or "full"), or an error string.
+    """
+    if schema is None:
+        schema = classify_drawing(data)
+    try:
+        new_png = revision_image(data)
+    except DECODE_ERRORS as e:
         return f"❌ Processing Error: {str(e)}"
+    digest = content_hash(data)
+    usage = {}
+    call_meta = {}
+    drawing_number = drawing_number or read_drawing_number(new_png, model, call_meta, schema)
+    add_usage(usage, call_meta.get("usage") or {})
+    previous = store.latest(drawing_number, exclude=digest) if drawing_number else None
+
+    regions, changed = [], 1.0
+    if previous is not None and previous[1] is not None:
+        regions, changed = change_regions(previous[1], new_png)
+
+    if previous is None or previous[1] is None or changed > REVISION_MAX_CHANGED or len(regions) > REVISION_MAX_REGIONS:
+        call_meta = {}
+        results = extract_drawing(data, model, call_meta, schema)
+        add_usage(usage, call_meta.get("usage") or {})
+        if isinstance(results, str):
+            return results
+        mode = "baseline" if previous is None else "full"
+    else:
+        # Crop from the full working image; the comparison copy is too small to read dimensions from
+        working = load_working_image(render_pdf_page(data) if is_pdf(data) else data)
+        scale = working.width / Image.open(io.BytesIO(new_png)).width
+        found = {}
+        for box in regions:
+            crop = working.crop(tuple(int(v * scale) for v in box))
+            call_meta = {}
+            reply = analyze_cylinder_image(image_to_png(crop), model, call_meta, schema=schema)
+            add_usage(usage, call_meta.get("usage") or {})
+            if reply.startswith("❌"):
+                return record_drawing(reply)
+            for key, value in parse_reply(reply, schema).items():
+                if key in schema.fields and value not in ("", MANUAL_VALUE):
+                    found[key] = value
+        results = record_drawing({**previous[0], **found})
+        mode = "regions" if regions else "unchanged"
+
+    if drawing_number and results.get("DRAWING NUMBER", MANUAL_VALUE) == MANUAL_VALUE:
+        results["DRAWING NUMBER"] = drawing_number
+    store.save(digest, source, results, new_png)
+    logger.info("revision %s: %s, %d regions, %.1f%% changed", drawing_number, mode, len(regions), changed * 100)
+    if meta is not None:
+        meta["usage"] = usage
+    return {
+        "drawing_number": drawing_number,
+        "schema": schema.name,
+        "mode": mode,
+        "results": results,
+        "previous": previous[0] if previous else None,
+        "previous_source": previous[2] if previous else None,
+        "regions": regions,
+        "changed": changed,
+        "image": new_png,
+    }
+
+def revision_diff_rows(revision, schema=DEFAULT_SCHEMA):
+    previous = revision["previous"] or {}
+    rows = []
+    for field in schema.fields:
+        before, after = previous.get(field, ""), revision["results"].get(field, "")
+        if not previous:
+            status = "new"
+        elif before == after:
+            status = "unchanged"
+        elif before in ("", MANUAL_VALUE):
+            status = "added"
+        elif after in ("", MANUAL_VALUE):
+            status = "removed"
+        else:
+            status = "changed"
+        rows.append({"Parameter": field, "Previous": before, "Current": after, "Status": status})
+    return rows
+
+class ArtifactStore:
+    """Content-addressed files shared by all sessions, read back through mmap.
+
+    Identical artifacts are stored once however many sessions hold them, and
+    their pages live in the OS page cache rather than the Python heap. Each
+    session keeps at most session_quota bytes referenced (its least recently
+    used references are dropped first); past max_bytes the least recently used
+    files are deleted, unreferenced ones before those a session still points at.
+    A session is forgotten once is_live(session_id) says it has ended, or once
+    all of its artifacts are gone.
+    """
+
+    def __init__(self, directory=ARTIFACT_DIR, max_bytes=ARTIFACT_STORE_MAX_BYTES, session_quota=ARTIFACT_SESSION_QUOTA,
+                 is_live=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.session_quota = session_quota
+        self.is_live = is_live
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> size, least recently used first
+        self.sessions = {}  # session id -> OrderedDict of referenced keys, least recently used first
+        self.total = 0
+        os.makedirs(directory, exist_ok=True)
+        # Files left by a previous process are adopted, oldest first, so they are evicted first
+        for entry in sorted(os.scandir(directory), key=lambda e: e.stat().st_mtime):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                self.entries[entry.name] = entry.stat().st_size
+                self.total += entry.stat().st_size
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def touch(self, session_id, key):
+        self.entries.move_to_end(key)
+        refs = self.sessions.setdefault(session_id, OrderedDict())
+        refs[key] = None
+        refs.move_to_end(key)
+
+    def put(self, session_id, data, key=None):
+        """Store bytes for a session under key (their content hash by default) and return the key."""
+        def write(path):
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return self.add(session_id, key or content_hash(data), len(data), write)
+
+    def put_file(self, session_id, path):
+        """Move a finished file in this store's directory into the store; returns its key."""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return self.add(session_id, digest.hexdigest(), os.path.getsize(path), lambda dest: os.replace(path, dest))
+
+    def add(self, session_id, key, size, write):
+        with self.lock:
+            self.prune()
+            if key not in self.entries:
+                write(self.path(key))
+                self.entries[key] = size
+                self.total += size
+            self.touch(session_id, key)
+            refs = self.sessions[session_id]
+            while len(refs) > 1 and self.session_bytes(session_id) > self.session_quota:
+                refs.popitem(last=False)
+            self.evict()
+        return key
+
+    def get(self, session_id, key):
+        """Read-only mmap of an artifact, or None if it has been evicted."""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.touch(session_id, key)
+            try:
+                with open(self.path(key), "rb") as f:
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):  # Deleted underneath us, or empty
+                return None
+
+    def release(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def prune(self):
+        """Drop the references of sessions that have ended. Called with the lock held."""
+        if self.is_live is not None:
+            for session_id in [s for s in self.sessions if not self.is_live(s)]:
+                del self.sessions[session_id]
+
+    def session_bytes(self, session_id):
+        return sum(self.entries.get(key, 0) for key in self.sessions.get(session_id, ()))
+
+    def evict(self):
+        if self.total <= self.max_bytes:
+            return
+        referenced = set().union(*self.sessions.values())
+        for only_unreferenced in (True, False):
+            for key in list(self.entries):
+                if self.total <= self.max_bytes:
+                    return
+                if only_unreferenced and key in referenced:
+                    continue
+                self.total -= self.entries.pop(key)
+                for session_id, refs in list(self.sessions.items()):
+                    refs.pop(key, None)
+                    if not refs:
+                        del self.sessions[session_id]
+                try:
+                    os.remove(self.path(key))  # Open mmaps stay valid until closed
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            self.prune()
+            return {
+                "bytes": self.total,
+                "max_bytes": self.max_bytes,
+                "artifacts": len(self.entries),
+                "sessions": len(self.sessions),
+            }
+
+@process_singleton
+def get_artifact_store():
+    return ArtifactStore(is_live=session_is_live)
+
+def current_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "script"
+
+def session_is_live(session_id):
+    """False once the browser session has closed; outside Streamlit there is only the script's own session."""
+    return not st.runtime.exists() or st.runtime.get_instance().is_active_session(session_id)
+
+def store_frame(df):
+    """Keep a DataFrame in the artifact store; returns its key."""
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False)
+    return get_artifact_store().put(current_session_id(), buffer.getvalue())
+
+def load_frame(key):
+    """DataFrame for a key from store_frame, or None if it has been evicted."""
+    data = get_artifact_store().get(current_session_id(), key) if key else None
+    return None if data is None else pq.read_table(pa.py_buffer(data)).to_pandas()
+
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):  # Not Linux
+        return None
+
+def release_session_artifacts():
+    get_artifact_store().release(current_session_id())
+    for key in ("results_key", "batch_tables", "preview_keys", "revision"):
+        st.session_state.pop(key, None)
+
+def memory_panel():
+    store = get_artifact_store()
+    stats = store.stats()
+    session_id = current_session_id()
+    mib = 1024 ** 2
+    with st.sidebar.expander("Memory"):
+        rss = process_rss_bytes()
+        if rss is not None:
+            st.write(f"Server process: {rss / mib:,.0f} MiB resident")
+        st.write(
+            f"Shared artifacts: {stats['bytes'] / mib:,.1f} of {stats['max_bytes'] / mib:,.0f} MiB "
+            f"({stats['artifacts']} files, {stats['sessions']} sessions)"
+        )
+        with store.lock:
+            mine = store.session_bytes(session_id)
+        st.progress(min(1.0, mine / store.session_quota), text=f"This session: {mine / mib:,.1f} of {store.session_quota / mib:,.0f} MiB")
+        st.button("Release my artifacts", key="release_artifacts", on_click=release_session_artifacts)
+
+def results_to_row(parsed_results, schema=DEFAULT_SCHEMA):
+    return {k: parsed_results.get(k, "") for k in schema.fields}  # Blank if missing
+
+def arrow_schema(schema=DEFAULT_SCHEMA):
+    fields = [pa.field("FILE", pa.string())]
+    for key in schema.fields:
+        if key in schema.units:
+            fields.append(pa.field(key, pa.float64(), metadata={"unit": schema.units[key]}))
+        else:
+            fields.append(pa.field(key, pa.string()))
+    return pa.schema(fields)
+
+def to_number(value):
+    match = re.search(r"-?\d+(?:\.\d+)?", value.replace(",", ".")) if value else None
+    return float(match.group()) if match else None
+
+def typed_row(source, parsed_results, schema=DEFAULT_SCHEMA):
+    """One wide row per drawing: numeric parameters as floats in their unit, the rest as text, missing as null."""
+    row = {"FILE": source}
+    for key in schema.fields:
+        value = parsed_results.get(key, "")
+        if value == MANUAL_VALUE:
+            value = ""
+        row[key] = to_number(value) if key in schema.units else (value or None)
+    return row
+
+class BatchExporter:
+    """Streams extraction results to Parquet, Arrow IPC stream and XLSX files as they arrive.
+
+    Rows are buffered up to flush_rows and then written out, so memory stays flat
+    however many drawings go through. Use as a context manager or call close().
+    """
+
+    def __init__(self, path_prefix, formats=tuple(EXPORT_FORMATS), flush_rows=EXPORT_FLUSH_ROWS, schema=DEFAULT_SCHEMA):
+        unknown = set(formats) - set(EXPORT_FORMATS)
+        if unknown:
+            raise ValueError(f"Unknown export formats: {', '.join(sorted(unknown))}")
+        if "xlsx" in formats and openpyxl is None:
+            raise RuntimeError("XLSX export requires openpyxl (pip install openpyxl)")
+
+        self.extraction_schema = schema
+        self.schema = arrow_schema(schema)
+        self.flush_rows = flush_rows
+        self.paths = {fmt: path_prefix + EXPORT_FORMATS[fmt] for fmt in formats}
+        self.rows = []
+        self.row_count = 0
+
+        self.parquet_writer = None
+        self.arrow_sink = self.arrow_writer = None
+        self.workbook = self.worksheet = None
+        if "parquet" in formats:
+            self.parquet_writer = pq.ParquetWriter(self.paths["parquet"], self.schema)
+        if "arrow" in formats:
+            self.arrow_sink = pa.OSFile(self.paths["arrow"], "wb")
+            self.arrow_writer = pa.ipc.new_stream(self.arrow_sink, self.schema)
+        if "xlsx" in formats:
+            # write_only workbooks stream rows to disk instead of keeping cells in memory
+            self.workbook = openpyxl.Workbook(write_only=True)
+            self.worksheet = self.workbook.create_sheet("Parameters")
+            self.worksheet.append([
+                f"{f.name} ({schema.units[f.name]})" if f.name in schema.units else f.name
+                for f in self.schema
+            ])
+
+    def write(self, source, parsed_results):
+        self.rows.append(typed_row(source, parsed_results, self.extraction_schema))
+        self.row_count += 1
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        batch = pa.RecordBatch.from_pylist(self.rows, schema=self.schema)
+        if self.parquet_writer is not None:
+            self.parquet_writer.write_batch(batch)
+        if self.arrow_writer is not None:
+            self.arrow_writer.write_batch(batch)
+        if self.worksheet is not None:
+            for row in self.rows:
+                self.worksheet.append([row[f.name] for f in self.schema])
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        if self.arrow_writer is not None:
+            self.arrow_writer.close()
+            self.arrow_sink.close()
+        if self.workbook is not None:
+            self.workbook.save(self.paths["xlsx"])
+        return self.paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def schema_selector(key):
+    """Component type picker; returns the chosen schema, or None to auto-detect per drawing."""
+    titles = {schema.title: schema for schema in SCHEMAS.values()}
+    choice = st.selectbox("Component Type", ["Auto-detect"] + list(titles), key=key)
+    return titles.get(choice)
+
+def batch_section():
+    uploaded_files = st.file_uploader(
+        "Select Files",
+        type=['png', 'jpg', 'jpeg', 'tif', 'tiff', 'pdf', 'zip', 'tar', 'tgz', 'gz', 'tbz2', 'bz2', 'txz', 'xz'],
+        accept_multiple_files=True, key="batch_uploader",
+        help="Zip and tar archives are read member by member; every drawing inside is extracted."
+    )
+    chosen_schema = schema_selector("batch_schema")
+    use_batching = st.checkbox(
+        "Pack small drawings into shared requests", value=True,
+        help="Sends several small sheets per API call; large sheets are always sent alone."
+    )
+    batch_budget = st.number_input(
+        "Token budget for this batch (0 = unlimited)", min_value=0, value=BATCH_TOKEN_BUDGET, step=10000,
+        help=f"Past {BUDGET_DOWNGRADE_AT:.0%} of the budget, drawings go to {BUDGET_FALLBACK_MODEL} "
+             f"at {BUDGET_FALLBACK_MAX_SIDE}px."
+    )
+
+    if 'batch_tables' not in st.session_state:
+        st.session_state.batch_tables = None
+
+    if uploaded_files and st.button("Process Drawings", key="batch_process_button"):
+        metrics = get_metrics()
+        governor = BudgetGovernor(batch_budget)
+        archives = [f for f in uploaded_files if is_archive(f.name)]
+        drawings = [f for f in uploaded_files if not is_archive(f.name)]
+        queued = QueueDepth(metrics, len(drawings))
+
+        store = get_artifact_store()
+        formats = [fmt for fmt in EXPORT_FORMATS if fmt != "xlsx" or openpyxl is not None]
+        # Export files are built next to the artifacts so finished ones move into the store without a copy
+        export_dir = tempfile.mkdtemp(dir=store.directory, suffix=".tmp")
+        exporters, errors, text_layer = {}, [], {}
+        export_lock = threading.Lock()
+
+        def export(name, result, schema):
+            # Text-layer values are exact, so they win over the VLM's reading
+            if name in text_layer and isinstance(result, dict):
+                result = {**result, **text_layer[name]}
+            with export_lock:
+                if isinstance(result, str):
+                    errors.append((name, result))
+                    return
+                if schema.name not in exporters:
+                    exporters[schema.name] = BatchExporter(
+                        os.path.join(export_dir, f"{schema.name}_parameters"), formats, schema=schema
+                    )
+                exporters[schema.name].write(name, result)
+
+        duplicates = {}
+        try:
+            with st.spinner(f'Processing {len(uploaded_files)} files...'), request_lane(interactive=False):
+                images, unsent = {}, []
+                # Gate and preprocess every scan up front so the process pool works on them in parallel
+                with ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS) as pool:
+                    checked = list(pool.map(
+                        lambda data: data if is_pdf(data) else quality_gate(data), [f.getvalue() for f in drawings]
+                    ))
+                # Each drawing is classified once so a single prompt extracts the right fields;
+                # the classifier calls are in flight side by side
+                with ThreadPoolExecutor(max_workers=PIPELINE_IO_WORKERS) as pool:
+                    classified = [
+                        None if chosen_schema or isinstance(data, str) else submit_in_context(pool, classify_drawing, data)
+                        for data in checked
+                    ]
+                for f, data, classifying in zip(drawings, checked, classified):
+                    if isinstance(data, str):
+                        unsent.append((f.name, data, None))
+                        continue
+                    schema = chosen_schema or classifying.result()
+                    if not is_pdf(data):
+                        images.setdefault(schema.name, []).append((f.name, data))
+                        continue
+                    try:
+                        fields, png_bytes = pdf_prepass(data, schema)
+                    except Exception as e:
+                        unsent.append((f.name, f"❌ Processing Error: {str(e)}", schema))
+                        continue
+                    text_layer[f.name] = fields
+                    if png_bytes is None:
+                        unsent.append((f.name, fields, schema))
+                    else:
+                        images.setdefault(schema.name, []).append((f.name, png_bytes))
+
+                # Drawings settled by the text layer or a pre-pass error never reach the API
+                for name, result, schema in unsent:
+                    export(name, record_drawing(result), schema)
+                    queued.dequeue()
+
+                try:
+                    for schema_name, schema_images in images.items():
+                        schema = SCHEMAS[schema_name]
+
+                        def on_result(name, result, schema=schema):
+                            queued.dequeue()
+                            export(name, result, schema)
+
+                        # The ladder makes its own requests, so it runs one drawing at a time
+                        if use_batching or not ADAPTIVE_RESOLUTION:
+                            analyze_cylinder_batch(
+                                schema_images, schema=schema, on_result=on_result, governor=governor, pack=use_batching
+                            )
+                        else:
+                            for name, image_bytes in schema_images:
+                                on_result(name, extract_drawing(image_bytes, schema=schema, governor=governor))
+                finally:
+                    queued.clear()
+
+                for f in archives:
+                    duplicates.update(analyze_archive(f, f.name, chosen_schema, governor, on_result=export)[2])
+
+            # One table and export set per component type; the Parquet export doubles as the table
+            session_id = current_session_id()
+            st.session_state.batch_tables = {}
+            for schema_name in list(exporters):
+                paths = exporters.pop(schema_name).close()
+                st.session_state.batch_tables[schema_name] = {
+                    fmt: store.put_file(session_id, path) for fmt, path in paths.items()
+                }
+        finally:
+            for exporter in exporters.values():
+                exporter.close()
+            shutil.rmtree(export_dir, ignore_errors=True)
+
+        for name, error in errors:
+            st.error(f"{name}: {error}")
+        if duplicates:
+            st.caption(f"Skipped {len(duplicates)} duplicate archive members: " + ", ".join(
+                f"{path} (same as {original})" for path, original in duplicates.items()
+            ))
+        st.caption(
+            f"Spent about {governor.batch.used():,} tokens"
+            + (f" of {batch_budget:,}" if batch_budget else "")
+            + (f"; {governor.downgrades} requests downgraded to stay within budget." if governor.downgrades else ".")
+        )
+
+    export_mimes = {
+        "parquet": "application/vnd.apache.parquet",
+        "arrow": "application/vnd.apache.arrow.stream",
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    }
+    for schema_name, export_keys in (st.session_state.batch_tables or {}).items():
+        st.write(f"### Extracted Parameters: {SCHEMAS[schema_name].title}")
+        df = load_frame(export_keys.get("parquet"))
+        if df is None:
+            st.info("This table was released to free server memory; process the batch again to see it.")
+            continue
+        st.dataframe(df, hide_index=True)
+        st.download_button(
+            label="Download CSV",
+            data=df.to_csv(index=False),
+            file_name=f"{schema_name}_parameters_batch.csv",
+            mime="text/csv",
+            key=f"batch_download_{schema_name}"
+        )
+        # An export is only read into memory once asked for, not on every rerun
+        for fmt, key in export_keys.items():
+            if st.session_state.get("batch_download") != (schema_name, fmt):
+                st.button(
+                    f"Prepare {fmt.upper()} download", key=f"batch_prepare_{schema_name}_{fmt}",
+                    on_click=st.session_state.__setitem__, args=("batch_download", (schema_name, fmt))
+                )
+                continue
+            data = get_artifact_store().get(current_session_id(), key)
+            if data is None:
+                st.info(f"The {fmt.upper()} export was released to free server memory; process the batch again.")
+                continue
+            st.download_button(
+                label=f"Download {fmt.upper()}",
+                data=data[:],
+                file_name=f"{schema_name}_parameters{EXPORT_FORMATS[fmt]}",
+                mime=export_mimes[fmt],
+                key=f"batch_download_{schema_name}_{fmt}",
+                on_click=st.session_state.pop, args=("batch_download", None)
+            )
+            data.close()
+
+def revision_section():
+    uploaded_file = st.file_uploader(
+        "Select the revised drawing", type=['png', 'jpg', 'jpeg', 'tif', 'tiff', 'pdf'], key="revision_uploader"
+    )
+    chosen_schema = schema_selector("revision_schema")
+    drawing_number = st.text_input(
+        "Drawing number", key="revision_drawing_number", help="Leave blank to read it from the title block."
+    )
+
+    if uploaded_file is not None and st.button("Compare With Previous Revision", key="revision_button"):
+        with st.spinner("Comparing with the previous revision..."), request_lane(interactive=True):
+            start = time.perf_counter()
+            revision = analyze_revision(
+                uploaded_file.getvalue(), get_results_store(), uploaded_file.name,
+                schema=chosen_schema, drawing_number=drawing_number.strip() or None
+            )
+            elapsed = time.perf_counter() - start
+        if isinstance(revision, str):
+            st.error(revision)
+            return
+
+        schema = SCHEMAS[revision["schema"]]
+        label = revision["drawing_number"] or "this drawing"
+        messages = {
+            "baseline": ("info", f"No earlier revision of {label} is stored; extracted in full and saved as the baseline."),
+            "unchanged": ("success", f"{label} is unchanged since the previous revision; every value was reused."),
+            "regions": ("success", f"{len(revision['regions'])} changed regions ({revision['changed']:.1%} of the sheet) "
+                                   f"were re-read; all other values were reused."),
+            "full": ("warning", f"{revision['changed']:.0%} of the sheet changed, so {label} was re-extracted in full."),
+        }
+        kind, text = messages[revision["mode"]]
+        if revision["previous_source"]:
+            text += f" Compared with {revision['previous_source']}."
+        overlay = None
+        if revision["regions"]:
+            image = Image.open(io.BytesIO(revision["image"])).convert("RGB")
+            draw = ImageDraw.Draw(image)
+            for box in revision["regions"]:
+                draw.rectangle(box, outline=(220, 0, 0), width=4)
+            overlay = get_artifact_store().put(current_session_id(), image_to_png(image))
+        st.session_state.revision = {
+            "table": store_frame(pd.DataFrame(revision_diff_rows(revision, schema))),
+            "overlay": overlay,
+            "message": (kind, f"{text} ({elapsed:.1f} s)"),
+            "schema": schema.name,
+        }
+
+    revision = st.session_state.get("revision")
+    if not revision:
+        return
+    kind, text = revision["message"]
+    getattr(st, kind)(text)
+    diff = load_frame(revision["table"])
+    if diff is None:
+        st.info("This comparison was released to free server memory; run it again to see it.")
+        return
+    highlight = lambda row: ["background-color: #fff3cd" if row["Status"] not in ("unchanged", "new") else ""] * len(row)
+    st.dataframe(diff.style.apply(highlight, axis=1), hide_index=True)
+    st.download_button(
+        label="Download Diff CSV",
+        data=diff.to_csv(index=False),
+        file_name=f"{revision['schema']}_revision_diff.csv",
+        mime="text/csv",
+        key="revision_download"
+    )
+    overlay = get_artifact_store().get(current_session_id(), revision["overlay"]) if revision["overlay"] else None
+    if overlay is not None:
+        st.image(overlay[:], caption="Changed regions")
+
+def operations_dashboard():
+    metrics = get_metrics()
+    stats = metrics.snapshot()
+
+    window = st.select_slider("Window", options=[15, 60, 240, 1440], value=60, format_func=lambda m: f"{m} min")
+    auto_refresh = st.toggle("Auto-refresh every 5 s")
+
+    calls = metrics.recent("api_calls", window)
+    cached_hits = metrics.recent("cassette_hits", window)
+    prompt_tokens = metrics.recent("prompt_tokens", window)
+    p50, p95 = stats.get("p50_latency_s"), stats.get("p95_latency_s")
+
+    row1 = st.columns(4)
+    row1[0].metric("Drawings / min (last 5 min)", f"{metrics.recent('drawings', 5) / 5:.1f}")
+    row1[1].metric("In-flight requests", stats.get("in_flight", 0))
+    row1[2].metric(
+        "Queue depth", stats.get("queue_depth", 0),
+        help=f"{stats.get('encoded_waiting', 0)} encoded and waiting for a connection"
+    )
+    row1[3].metric("Latency p50 / p95", f"{p50:.1f} / {p95:.1f} s" if p50 is not None else "–")
+
+    row2 = st.columns(4)
+    row2[0].metric("Error rate", f"{metrics.recent('api_errors', window) / calls:.1%}" if calls else "–")
+    row2[1].metric("Retry rate", f"{metrics.recent('retries', window) / calls:.1%}" if calls else "–")
+    row2[2].metric(
+        "Prompt cache hit rate",
+        f"{metrics.recent('cached_tokens', window) / prompt_tokens:.1%}" if prompt_tokens else "–",
+        help="Share of prompt tokens served from the provider's prompt cache"
+    )
+    row2[3].metric(
+        "Replay cache hit rate",
+        f"{cached_hits / (calls + cached_hits):.1%}" if calls + cached_hits else "–",
+        help="Share of requests answered from the record/replay cassette"
+    )
+
+    st.write("### Throughput")
+    st.line_chart(metrics.series(
+        ["drawings", "drawing_errors", "api_calls", "api_errors", "retries", "quality_rejects", "payload_reductions"], window
+    ))
+    st.write("### Token Spend")
+    st.area_chart(metrics.series(["prompt_tokens", "cached_tokens", "completion_tokens"], window))
+    st.caption(
+        f"Total: {stats.get('prompt_tokens', 0):,} prompt + {stats.get('completion_tokens', 0):,} completion tokens, "
+        f"${stats.get('cost_usd', 0):.4f} reported cost. Counts cover this server process only."
+    )
+    if HOURLY_TOKEN_BUDGET:
+        hourly = get_hourly_budget()
+        st.progress(
+            min(1.0, hourly.used_fraction()),
+            text=f"Hourly token budget: {hourly.used_fraction():.0%} of {HOURLY_TOKEN_BUDGET:,} used, "
+                 f"{stats.get('budget_downgrades', 0)} downgrades, {stats.get('budget_waits', 0)} throttled requests"
+        )
+
+    st.write("### Fair-Share Scheduler")
+    users, interactive_waiting = get_scheduler().snapshot()
+
+    def average_wait(lane):
+        lane_calls = metrics.recent(f"{lane}_calls", window)
+        return f"{metrics.recent(f'{lane}_wait_s', window) / lane_calls:.2f} s" if lane_calls else "–"
+    st.caption(
+        f"Average wait for a call slot: {average_wait('interactive')} interactive, {average_wait('batch')} batch. "
+        f"{interactive_waiting} interactive calls waiting now."
+    )
+    if users:
+        st.dataframe(pd.DataFrame(users), hide_index=True)
+
+    st.write("### Backends")
+    st.dataframe(pd.DataFrame([backend.describe() for backend in get_backends()]), hide_index=True)
+    st.caption(
+        "Requests go to the first backend able to serve them." if BACKEND_ROUTING != "latency"
+        else "Requests go to the capable backend with the lowest recent median latency; failed calls count as slow."
+    )
+
+    if auto_refresh:
+        time.sleep(5)
+        st.rerun()
 
 def main():
     # Set page config
@@ -101,65 +2631,142 @@ def main():
     # Title
     st.title("JSW Engineering Drawing DataSheet Extractor")
 
-    # Define expected parameters in the new order
-    parameters = [
-        "CYLINDER ACTION",
-        "BORE DIAMETER",
-        "OUTSIDE DIAMETER",  # Moved below BORE DIAMETER
-        "ROD DIAMETER",
-        "STROKE LENGTH",
-        "CLOSE LENGTH",
-        "OPEN LENGTH",  # Kept blank by default
-        "OPERATING PRESSURE",
-        "OPERATING TEMPERATURE",
-        "MOUNTING",  # Kept blank by default
-        "ROD END",  # Kept blank by default
-        "FLUID",
-        "DRAWING NUMBER"  # New field added
-    ]
+    page = st.sidebar.radio("Page", ["Extractor", "Operations"])
+    memory_panel()
+    if page == "Operations":
+        operations_dashboard()
+        return
+
+    if HEDGE_ENABLED:
+        stats = get_metrics().snapshot()
+        st.sidebar.write("### Hedged Requests")
+        st.sidebar.write(
+            f"Hedge rate: {stats['hedge_rate']:.1%}  \n"
+            f"Backup wins: {stats.get('hedge_wins', 0)}  \n"
+            f"Time saved: {stats.get('hedge_saved_s', 0):.0f} s"
+        )
 
-    # File uploader and processing section
-    uploaded_file = st.file_uploader("Select File", type=['png', 'jpg', 'jpeg'])
+    single_tab, batch_tab, revision_tab = st.tabs(["Single Drawing", "Batch", "Revision Diff"])
 
-    if uploaded_file is not None:
-        col1, col2 = st.columns([3, 2])
+    with single_tab:
+        # File uploader and processing section
+        uploaded_file = st.file_uploader("Select File", type=['png', 'jpg', 'jpeg', 'tif', 'tiff', 'pdf'])
+
+        if uploaded_file is not None:
+            col1, col2 = st.columns([3, 2])
         
-        with col1:
-            if 'results_df' not in st.session_state:
-                st.session_state.results_df = None
-
-            if st.button("Process Drawing", key="process_button"):
-                with st.spinner('Processing drawing...'):
-                    uploaded_file.seek(0)
-                    image_bytes = uploaded_file.read()
+            with col1:
+                if 'results_key' not in st.session_state:
+                    st.session_state.results_key = None
+
+                chosen_schema = schema_selector("single_schema")
+                use_adaptive = st.checkbox(
+                    "Adaptive resolution", value=ADAPTIVE_RESOLUTION,
+                    help="Starts with a low-resolution image and only escalates when fields are missing or invalid."
+                )
+                use_voting = st.checkbox(
+                    "Self-consistency voting for low-confidence drawings",
+                    help=f"Re-samples up to {VOTING_SAMPLES} answers in parallel and majority-votes each field."
+                )
+
+                if st.button("Process Drawing", key="process_button"):
+                    with st.spinner('Processing drawing...'), request_lane(interactive=True):
+                        uploaded_file.seek(0)
+                        image_bytes = uploaded_file.read()
                     
-                    result = analyze_cylinder_image(image_bytes)
+                        # Unusable scans are rejected before classification, which is an API call too
+                        checked = image_bytes if is_pdf(image_bytes) else quality_gate(image_bytes)
+                        call_meta = {}
+                        if isinstance(checked, str):
+                            result = checked
+                        else:
+                            image_bytes = checked
+                            schema = chosen_schema or classify_drawing(image_bytes)
+                            if is_pdf(image_bytes):
+                                result = analyze_drawing_pdf(image_bytes, schema=schema)
+                            elif use_adaptive:
+                                result = analyze_adaptive(image_bytes, schema=schema)
+                            else:
+                                result = analyze_cylinder_image(image_bytes, meta=call_meta, schema=schema)
                     
-                    if "❌ API Error" in result or "❌ Processing Error" in result:
-                        st.error(result)
-                    else:
-                        parsed_results = parse_ai_response(result)
-                        st.session_state.results_df = pd.DataFrame([
-                            {"Parameter": k, "Value": parsed_results.get(k, "")}  # Blank if missing
-                            for k in parameters
-                        ])
-                        st.success("✅ Drawing processed successfully!")
-
-            if st.session_state.results_df is not None:
-                st.write("### Extracted Parameters")
-                st.table(st.session_state.results_df)
+                        record_drawing(result)
+                        if isinstance(result, str) and ("❌ API Error" in result or "❌ Processing Error" in result):
+                            st.error(result)
+                        else:
+                            unmatched = []
+                            parsed_results = (
+                                result if isinstance(result, dict) else parse_ai_response(result, schema, unmatched)
+                            )
+                            voted = None
+                            if use_voting and not is_pdf(image_bytes) and is_low_confidence(parsed_results, schema):
+                                voted = analyze_with_voting(image_bytes, parsed_results, schema=schema)
+
+                            if voted is None:
+                                results_df = pd.DataFrame([
+                                    {"Parameter": k, "Value": v}
+                                    for k, v in results_to_row(parsed_results, schema).items()
+                                ])
+                            else:
+                                results_df = pd.DataFrame([
+                                    {"Parameter": k, "Value": v, "Confidence": f"{c:.0%}"}
+                                    for k, (v, c) in voted.items()
+                                ])
+                            st.session_state.results_key = store_frame(results_df)
+                            st.session_state.results_schema = schema.name
+                            st.success(f"✅ Drawing processed successfully as {schema.title}!")
+                            if unmatched:
+                                st.caption(f"Ignored lines in the reply with unknown keys: {', '.join(unmatched)}")
+                            for reduction in call_meta.get("payload_reductions", []):
+                                st.caption(
+                                    f"Sent at {reduction['max_side']}px, {reduction['mime']} quality "
+                                    f"{reduction['quality']} ({reduction['sent_bytes'] / 1024 ** 2:.1f} MiB instead of "
+                                    f"{reduction['original_bytes'] / 1024 ** 2:.1f} MiB) to fit the request size limit."
+                                )
+
+                results_df = load_frame(st.session_state.results_key)
+                if st.session_state.results_key is not None and results_df is None:
+                    st.info("These results were released to free server memory; process the drawing again.")
+                if results_df is not None:
+                    st.write("### Extracted Parameters")
+                    st.table(results_df)
             
-                csv = st.session_state.results_df.to_csv(index=False)
-                st.download_button(
-                    label="Download CSV",
-                    data=csv,
-                    file_name="cylinder_parameters.csv",
-                    mime="text/csv"
-                )
+                    csv = results_df.to_csv(index=False)
+                    st.download_button(
+                        label="Download CSV",
+                        data=csv,
+                        file_name=f"{st.session_state.get('results_schema', DEFAULT_SCHEMA.name)}_parameters.csv",
+                        mime="text/csv"
+                    )
+
+            with col2:
+                # The preview is rendered once per upload and shared through the artifact store
+                store = get_artifact_store()
+                upload_hash = content_hash(uploaded_file.getvalue())
+                preview_keys = st.session_state.setdefault("preview_keys", {})
+                preview = store.get(current_session_id(), preview_keys[upload_hash]) if upload_hash in preview_keys else None
+                if preview is None:
+                    try:
+                        if not is_pdf(uploaded_file.getvalue()):
+                            preview_png = image_to_png(load_working_image(uploaded_file.getvalue(), PREVIEW_MAX_SIDE))
+                        elif pymupdf is not None:
+                            preview_png = render_pdf_page(uploaded_file.getvalue(), dpi=72)
+                        else:
+                            preview_png = None
+                            st.warning("Install PyMuPDF to preview and process PDF drawings.")
+                    except DECODE_ERRORS as e:
+                        preview_png = None
+                        st.warning(str(e))
+                    if preview_png is not None:
+                        st.session_state.preview_keys = {upload_hash: store.put(current_session_id(), preview_png)}
+                        preview = preview_png
+                if preview is not None:
+                    st.image(preview[:], caption="Uploaded Technical Drawing")
+
+    with batch_tab:
+        batch_section()
 
-        with col2:
-            image = Image.open(uploaded_file)
-            st.image(image, caption="Uploaded Technical Drawing")
+    with revision_tab:
+        revision_section()
 
 if __name__ == "__main__":
     main()
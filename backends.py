@@ -0,0 +1,247 @@
+"""Inference backends behind post_chat.
+
+Every adapter takes an OpenAI-style chat-completions payload, as app.py builds
+it, and returns (HTTP status, OpenAI-style response JSON), so callers and the
+cassette never see which provider answered. Adapters declare what they can do
+(streaming, JSON mode, several images per request); route() picks among the
+ones able to serve a request, by preference order or by recent latency.
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from dotenv import load_dotenv
+
+try:
+    from mistralai import Mistral, models as mistral_models  # Only needed for the mistral backend
+except ImportError:
+    Mistral = None
+
+load_dotenv()  # Imported before app.py loads .env
+
+# BACKENDS lists where requests may go, most preferred first: openrouter, mistral,
+# openai (any OpenAI-compatible endpoint at OPENAI_COMPAT_URL) and local (a vLLM or
+# llama.cpp server). BACKEND_ROUTING is "first" (the first backend able to serve a
+# request) or "latency" (the one with the lowest recent median latency).
+BACKENDS = [b.strip() for b in os.getenv("BACKENDS", "openrouter").split(",") if b.strip()]
+BACKEND_ROUTING = os.getenv("BACKEND_ROUTING", "first")
+BACKEND_EXPLORE_RATE = float(os.getenv("BACKEND_EXPLORE_RATE", "0.05"))  # Re-measures backends latency routing avoids
+BACKEND_LATENCY_WINDOW = 50  # Recent calls per backend kept for routing
+BACKEND_ERROR_PENALTY_S = 60.0  # A failed call counts as this slow
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_API_KEY = os.getenv("API_KEY")
+MISTRAL_URL = "https://api.mistral.ai/v1/chat/completions"
+MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
+MISTRAL_MODEL = os.getenv("MISTRAL_MODEL", "pixtral-large-latest")  # For requested models with no Mistral id
+# Mistral ids for the OpenRouter ids app.py requests, as "requested=mistral id,...";
+# "mistralai/..." ids need no entry, Mistral knows them without the prefix
+MISTRAL_MODEL_MAP = os.getenv("MISTRAL_MODEL_MAP", "")
+OPENAI_COMPAT_URL = os.getenv("OPENAI_COMPAT_URL")  # Full .../v1/chat/completions URL
+OPENAI_COMPAT_API_KEY = os.getenv("OPENAI_COMPAT_API_KEY", "")
+OPENAI_COMPAT_MODEL = os.getenv("OPENAI_COMPAT_MODEL")
+OPENAI_COMPAT_MULTI_IMAGE = os.getenv("OPENAI_COMPAT_MULTI_IMAGE", "1") == "1"
+LOCAL_URL = os.getenv("LOCAL_URL", "http://localhost:8000/v1/chat/completions")  # vLLM's default port
+LOCAL_MODEL = os.getenv("LOCAL_MODEL")  # Unset: send the payload's model name
+LOCAL_MULTI_IMAGE = os.getenv("LOCAL_MULTI_IMAGE", "0") == "1"  # vLLM needs --limit-mm-per-prompt; llama.cpp can't
+
+
+class RequestTooLarge(ValueError):
+    pass
+
+
+def parse_model_map(text):
+    """{requested model: backend model} from "a=b,c=d"."""
+    pairs = (item.split("=", 1) for item in text.split(",") if "=" in item)
+    return {requested.strip(): model.strip() for requested, model in pairs}
+
+
+def request_body(payload):
+    """Serialise a payload the way requests would, so its size can be checked before sending."""
+    return json.dumps(payload, allow_nan=False).encode("utf-8")
+
+
+def request_needs(payload):
+    """What a payload asks of a backend: (images, JSON mode, streaming)."""
+    images = sum(
+        1 for message in payload["messages"] if isinstance(message["content"], list)
+        for part in message["content"] if part.get("type") == "image_url"
+    )
+    json_mode = (payload.get("response_format") or {}).get("type") in ("json_object", "json_schema")
+    return images, json_mode, bool(payload.get("stream"))
+
+
+def without_openrouter_fields(payload):
+    """The payload minus OpenRouter's usage accounting and cache_control markers, which other servers reject."""
+    payload = {key: value for key, value in payload.items() if key != "usage"}
+    payload["messages"] = [
+        {**message, "content": [
+            {key: value for key, value in part.items() if key != "cache_control"} for part in message["content"]
+        ]} if isinstance(message["content"], list) else message
+        for message in payload["messages"]
+    ]
+    return payload
+
+
+class Backend:
+    """One inference provider. Subclasses implement send(payload, max_bytes) -> (status, response JSON).
+
+    The payload's model name is an OpenRouter id. models maps requested ids to this
+    backend's own; model, when set, replaces every id models has no entry for.
+    """
+
+    def __init__(self, name, url, model=None, streaming=False, json_mode=False, multi_image=False, models=None):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.models = models or {}
+        self.streaming = streaming
+        self.json_mode = json_mode
+        self.multi_image = multi_image
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=BACKEND_LATENCY_WINDOW)
+
+    def model_for(self, requested):
+        return self.models.get(requested) or self.model or requested
+
+    def can_serve(self, payload):
+        images, json_mode, streaming = request_needs(payload)
+        return (images <= 1 or self.multi_image) and (self.json_mode or not json_mode) and (self.streaming or not streaming)
+
+    def complete(self, payload, max_bytes=None):
+        """Send payload; returns (status, response JSON). RequestTooLarge if the body exceeds max_bytes."""
+        start = time.perf_counter()
+        try:
+            status, response_json = self.send(payload, max_bytes)
+        except RequestTooLarge:
+            raise  # Never sent, so says nothing about this backend
+        except Exception:
+            self.observe(BACKEND_ERROR_PENALTY_S)
+            raise
+        self.observe(time.perf_counter() - start if status == 200 else BACKEND_ERROR_PENALTY_S)
+        return status, response_json
+
+    def observe(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def expected_latency(self):
+        """Median of recent calls; 0 for an untried backend, so each one gets measured."""
+        with self.lock:
+            samples = sorted(self.latencies)
+        return samples[len(samples) // 2] if samples else 0.0
+
+    def describe(self):
+        with self.lock:
+            calls = len(self.latencies)
+        capabilities = [flag for flag in ("streaming", "json_mode", "multi_image") if getattr(self, flag)]
+        return {
+            "Backend": self.name,
+            "Model": (self.model or "as requested") + (f" ({len(self.models)} mapped)" if self.models else ""),
+            "Capabilities": ", ".join(capabilities) or "–",
+            "Median latency (s)": round(self.expected_latency(), 2) if calls else None,
+            "Recent calls": calls,
+        }
+
+    def check_size(self, body_size, max_bytes):
+        if max_bytes is not None and body_size > max_bytes:
+            raise RequestTooLarge(
+                f"request is {body_size / 1024 ** 2:.1f} MiB, over the {max_bytes / 1024 ** 2:.1f} MiB "
+                "MAX_REQUEST_BYTES limit"
+            )
+
+
+class OpenAICompatibleBackend(Backend):
+    """Any server speaking the chat-completions protocol: vLLM, llama.cpp, TGI, OpenAI itself."""
+
+    def __init__(self, name, url, api_key="", model=None, **capabilities):
+        super().__init__(name, url, model, **capabilities)
+        self.api_key = api_key
+
+    def prepare(self, payload):
+        payload = without_openrouter_fields(payload)
+        payload["model"] = self.model_for(payload["model"])
+        return payload
+
+    def send(self, payload, max_bytes=None):
+        body = request_body(self.prepare(payload))
+        self.check_size(len(body), max_bytes)
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        response = requests.post(self.url, headers=headers, data=body)
+        return response.status_code, response.json()
+
+
+class OpenRouterBackend(OpenAICompatibleBackend):
+    """OpenRouter, which takes the payload as app.py builds it, usage accounting and cache breakpoints included."""
+
+    def prepare(self, payload):
+        return {**payload, "model": self.model_for(payload["model"])}
+
+
+class MistralBackend(Backend):
+    """Mistral's API through the mistralai SDK. Pixtral models read several images per request."""
+
+    def __init__(self, name, api_key, model=MISTRAL_MODEL, models=None, **capabilities):
+        super().__init__(name, MISTRAL_URL, model, models=models, **capabilities)
+        self.client = Mistral(api_key=api_key) if Mistral is not None else None
+
+    def model_for(self, requested):
+        if requested not in self.models and requested.startswith("mistralai/"):
+            return requested[len("mistralai/"):]
+        return super().model_for(requested)
+
+    def send(self, payload, max_bytes=None):
+        if self.client is None:
+            raise RuntimeError("the mistral backend needs the mistralai package")
+        payload = without_openrouter_fields(payload)
+        self.check_size(len(request_body(payload)), max_bytes)
+        options = {key: payload[key] for key in ("temperature", "max_tokens", "response_format") if key in payload}
+        try:
+            response = self.client.chat.complete(
+                model=self.model_for(payload["model"]), messages=payload["messages"], **options
+            )
+        except mistral_models.HTTPValidationError as e:
+            return 422, {"error": str(e)}
+        except mistral_models.SDKError as e:
+            return e.status_code, {"error": e.message, "body": e.body}
+        return 200, response.model_dump()
+
+
+def build_backend(name):
+    if name == "openrouter":
+        return OpenRouterBackend(
+            "openrouter", OPENROUTER_URL, OPENROUTER_API_KEY, streaming=True, json_mode=True, multi_image=True
+        )
+    if name == "mistral":
+        return MistralBackend(
+            "mistral", MISTRAL_API_KEY, models=parse_model_map(MISTRAL_MODEL_MAP),
+            streaming=True, json_mode=True, multi_image=True
+        )
+    if name == "openai":
+        if not OPENAI_COMPAT_URL:
+            raise ValueError("The openai backend needs OPENAI_COMPAT_URL")
+        return OpenAICompatibleBackend(
+            "openai", OPENAI_COMPAT_URL, OPENAI_COMPAT_API_KEY, OPENAI_COMPAT_MODEL,
+            streaming=True, json_mode=True, multi_image=OPENAI_COMPAT_MULTI_IMAGE
+        )
+    if name == "local":
+        return OpenAICompatibleBackend(
+            "local", LOCAL_URL, model=LOCAL_MODEL, streaming=True, json_mode=True, multi_image=LOCAL_MULTI_IMAGE
+        )
+    raise ValueError(f"Unknown backend {name!r} in BACKENDS; choose from openrouter, mistral, openai, local")
+
+
+def route(backends, payload, strategy=BACKEND_ROUTING):
+    """The backend to send payload to, or None when none of them can serve it."""
+    candidates = [b for b in backends if b.can_serve(payload)]
+    if len(candidates) < 2 or strategy != "latency":
+        return candidates[0] if candidates else None
+    if random.random() < BACKEND_EXPLORE_RATE:
+        return random.choice(candidates)
+    return min(candidates, key=lambda b: b.expected_latency())
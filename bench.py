@@ -0,0 +1,135 @@
+"""Benchmark suite for the extraction pipeline.
+
+Usage: python bench.py [--suite prompt|batch] drawing1.png drawing2.jpg ...
+       python bench.py --suite parse [reply1.txt reply2.txt ...]
+"""
+import argparse
+import statistics
+import time
+import timeit
+
+from app import (
+    DEFAULT_SCHEMA, MANUAL_VALUE, MODEL, SCHEMAS, analyze_cylinder_batch, analyze_cylinder_image,
+    parse_ai_response, plan_batches
+)
+
+# Reply styles seen in production, used when no recorded replies are given
+SAMPLE_REPLIES = [
+    "\n".join(f"{field}: 63 MM" for field in DEFAULT_SCHEMA.fields),
+    "Here are the extracted values:\n\n"
+    "- **Bore Dia (mm):** 63\n- **Rod Dia (mm):** 45\n- **Stroke:** 200 MM\n- **Closed Length:** 410 MM\n"
+    "- **Open Lg:** N/A\n- **Working Press:** 160 bar\n- **Mounting:**\n  Front flange\n  with 4 x M16\n"
+    "- **Drawing #:** CYL-0042-B\n\nNote: values read from the title block.",
+    "```\nCYLINDER ACTION: DOUBLE-ACTION\nBORE DIAMETER: 80 MM\nROD DIAMETER: \"56 MM\"\n"
+    "STROKE LENGTH: 500 MM\nFLUID: Mineral oil HLP 46\nDRAWING NUMBER: H-88120\n```",
+]
+
+
+def split_parse(response_text):
+    """The original per-line parser, kept as the baseline."""
+    results = {}
+    for line in response_text.split('\n'):
+        if ':' in line:
+            key, value = line.split(':', 1)
+            value = value.strip()
+            results[key.strip().upper()] = value if value else MANUAL_VALUE
+    return results
+
+
+def bench_prompt_tokens(paths, model=MODEL, repeat=1):
+    """Send each drawing and report latency and prompt token usage per call."""
+    rows = []
+    for path in paths:
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        for _ in range(repeat):
+            meta = {}
+            start = time.perf_counter()
+            result = analyze_cylinder_image(image_bytes, model=model, meta=meta)
+            elapsed = time.perf_counter() - start
+            usage = meta.get("usage") or {}
+            cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+            rows.append({
+                "file": path,
+                "ok": not result.startswith("❌"),
+                "latency_s": elapsed,
+                "prompt_tokens": usage.get("prompt_tokens", 0),
+                "cached_tokens": cached or 0,
+                "completion_tokens": usage.get("completion_tokens", 0),
+            })
+            print(f"{path}: {elapsed:.2f}s prompt={rows[-1]['prompt_tokens']} "
+                  f"cached={rows[-1]['cached_tokens']} completion={rows[-1]['completion_tokens']}")
+    return rows
+
+
+def bench_batching(paths, model=MODEL):
+    """Compare drawings/second for one-image-per-call against packed multi-image calls."""
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append((path, f.read()))
+
+    start = time.perf_counter()
+    single_ok = sum(not analyze_cylinder_image(b, model=model).startswith("❌") for _, b in images)
+    single_s = time.perf_counter() - start
+
+    batches = plan_batches(images, model)
+    start = time.perf_counter()
+    results = analyze_cylinder_batch(images, model=model)
+    batch_s = time.perf_counter() - start
+    batch_ok = sum(isinstance(r, dict) for r in results.values())
+
+    print(f"single: {len(images)} calls, {single_ok} ok, {single_s:.2f}s, "
+          f"{len(images) / single_s:.2f} drawings/s")
+    print(f"batched: {len(batches)} calls (sizes {[len(b) for b in batches]}), {batch_ok} ok, "
+          f"{batch_s:.2f}s, {len(images) / batch_s:.2f} drawings/s")
+
+
+def bench_parser(paths=(), schema=DEFAULT_SCHEMA, number=20000):
+    """Time the reply parser against the per-line baseline, and how many schema fields each recovers."""
+    replies = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            replies.append(f.read())
+    replies = replies or SAMPLE_REPLIES
+
+    for label, parse in (("split baseline", split_parse), ("alias parser", lambda r: parse_ai_response(r, schema))):
+        seconds = min(timeit.repeat(lambda: [parse(r) for r in replies], number=max(1, number // len(replies)), repeat=3))
+        calls = max(1, number // len(replies)) * len(replies)
+        recovered = sum(
+            sum(1 for k, v in parse(r).items() if k in schema.fields and v != MANUAL_VALUE) for r in replies
+        )
+        print(f"{label:>16}: {seconds / calls * 1e6:7.2f} us/reply  {calls / seconds:10,.0f} replies/s  "
+              f"{recovered} fields recovered from {len(replies)} replies")
+
+def summarize(rows):
+    if not rows:
+        return
+    print(f"\ncalls: {len(rows)}  ok: {sum(r['ok'] for r in rows)}")
+    for key in ("latency_s", "prompt_tokens", "cached_tokens", "completion_tokens"):
+        values = [r[key] for r in rows]
+        print(f"{key:>18}: mean={statistics.mean(values):.2f} median={statistics.median(values):.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", help="Drawing files to send, or reply text files for --suite parse")
+    parser.add_argument("--suite", choices=["prompt", "batch", "parse"], default="prompt")
+    parser.add_argument("--schema", choices=sorted(SCHEMAS), default=DEFAULT_SCHEMA.name)
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--repeat", type=int, default=2,
+                        help="Calls per drawing; repeats show prompt cache hits")
+    args = parser.parse_args()
+    if args.suite != "parse" and not args.images:
+        parser.error(f"--suite {args.suite} needs at least one drawing")
+
+    if args.suite == "parse":
+        bench_parser(args.images, SCHEMAS[args.schema])
+    elif args.suite == "prompt":
+        summarize(bench_prompt_tokens(args.images, model=args.model, repeat=args.repeat))
+    elif args.suite == "batch":
+        bench_batching(args.images, model=args.model)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Decoding and request encoding of drawing images.
+
+Turning an upload into the data: URL that goes into a request is CPU-bound, so
+app.py runs it in a process pool while earlier requests are on the wire (see
+get_preprocess_pool there).
+"""
+import base64
+import io
+import math
+import os
+
+from dotenv import load_dotenv
+from PIL import Image
+
+load_dotenv()  # Imported before app.py loads .env
+
+# Decoding budget: no bitmap larger than MAX_DECODE_PIXELS is materialised. Bigger
+# scans are reduced to WORKING_MAX_SIDE while decoding (JPEG draft mode, row bands
+# for uncompressed TIFF/BMP/PPM) or rejected: Pillow decodes PNG and compressed TIFF
+# (LZW, Deflate, Group 4) only as a whole bitmap. MAX_SOURCE_PIXELS replaces Pillow's
+# decompression-bomb limit, which would refuse A0 scans at 600 dpi outright.
+MAX_DECODE_PIXELS = int(os.getenv("MAX_DECODE_PIXELS", str(64 * 1024 * 1024)))
+WORKING_MAX_SIDE = int(os.getenv("WORKING_MAX_SIDE", "4096"))
+MAX_SOURCE_PIXELS = int(os.getenv("MAX_SOURCE_PIXELS", str(2 * 1024 ** 3)))
+Image.MAX_IMAGE_PIXELS = MAX_SOURCE_PIXELS
+# What decoding a damaged, truncated or oversized upload raises
+DECODE_ERRORS = (ValueError, OSError, Image.DecompressionBombError)
+
+# Request image encoding. IMAGE_ENCODING is "auto" (smallest accepted format at
+# ENCODING_QUALITY), "original" (send uploads untouched) or a format name.
+IMAGE_ENCODING = os.getenv("IMAGE_ENCODING", "auto")
+ENCODING_QUALITY = int(os.getenv("ENCODING_QUALITY", "90"))
+ENCODING_MIN_BYTES = int(os.getenv("ENCODING_MIN_BYTES", str(256 * 1024)))  # Smaller uploads are sent as-is
+PROVIDER_IMAGE_FORMATS = os.getenv("PROVIDER_IMAGE_FORMATS", "png,jpeg,webp").split(",")
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+# Images too large for the request are re-encoded at PAYLOAD_QUALITY_STEPS, then
+# shrunk by PAYLOAD_SCALE_STEP per step; below PAYLOAD_MIN_SIDE they are rejected instead.
+PAYLOAD_QUALITY_STEPS = [int(q) for q in os.getenv("PAYLOAD_QUALITY_STEPS", "80,65").split(",")]
+PAYLOAD_SCALE_STEP = 0.75
+PAYLOAD_MIN_SIDE = int(os.getenv("PAYLOAD_MIN_SIDE", "768"))  # Dimension text is unreadable much below this
+
+
+def decode_raw_bands(image, data, factor, max_pixels):
+    """Decode uncompressed tiles a band of rows at a time, reducing each band before the next."""
+    width, height = image.size
+    out = Image.new(image.mode, (math.ceil(width / factor), math.ceil(height / factor)))
+    band_rows = max(factor, (max_pixels // 4 // width) // factor * factor)
+    buffer = memoryview(data)
+    for _, (x0, y0, x1, y1), offset, (rawmode, stride, orientation) in image.tile:
+        tile_width, tile_height = x1 - x0, y1 - y0
+        stride = stride or len(Image.new(image.mode, (tile_width, 1)).tobytes())
+        for top in range(0, tile_height, band_rows):
+            rows = min(band_rows, tile_height - top)
+            # Bottom-up files (BMP) store the last row first
+            first = top if orientation > 0 else tile_height - top - rows
+            chunk = buffer[offset + first * stride:offset + (first + rows) * stride]
+            band = Image.frombuffer(image.mode, (tile_width, rows), chunk, "raw", rawmode, stride, orientation)
+            out.paste(band.reduce(factor) if factor > 1 else band, (x0 // factor, (y0 + top) // factor))
+    return out
+
+
+def load_working_image(data, max_side=WORKING_MAX_SIDE, max_pixels=MAX_DECODE_PIXELS):
+    """Decode a drawing at no more than max_side pixels per side without materialising the full bitmap.
+
+    Raises ValueError when a file can only be decoded whole and that would exceed max_pixels.
+    """
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    if image.format == "JPEG" and max(width, height) > max_side:
+        # The JPEG decoder scales by 1/2, 1/4 or 1/8 in the DCT domain: take the strongest
+        # scale that stays at or above max_side, or a stronger one if the budget demands it.
+        scales = (1, 2, 4, 8)
+        for_side = max(s for s in scales if s == 1 or max(width, height) // s >= max_side)
+        for_budget = next((s for s in scales if (width // s) * (height // s) <= max_pixels), 8)
+        scale = max(for_side, for_budget)
+        if scale > 1:
+            image.draft(image.mode if image.mode in ("L", "RGB") else "RGB", (width // scale, height // scale))
+            width, height = image.size
+
+    factor = max(1, math.ceil(max(width, height) / max_side))
+    if width * height > max_pixels:
+        if not image.tile or any(tile[0] != "raw" for tile in image.tile) or image.mode in ("1", "P"):
+            raise ValueError(
+                f"{width}x{height} {image.format} drawing is too large to read: this file type can only be "
+                f"decoded whole, which would exceed the budget of {max_pixels:,} pixels (MAX_DECODE_PIXELS). "
+                "Save it as JPEG or uncompressed TIFF, or scan it at a lower resolution."
+            )
+        return decode_raw_bands(image, data, factor, max_pixels)
+
+    image.load()
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side))
+    return image
+
+
+def sniff_image_mime(image_bytes):
+    """Identify the image format from its magic bytes; None if unknown."""
+    for signature, mime in IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return mime
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    if image_bytes[4:8] == b"ftyp" and image_bytes[8:12] in (b"avif", b"avis"):
+        return "image/avif"
+    return None
+
+
+def encoding_candidates(image, policy, quality):
+    """Yield (mime, bytes) renderings allowed by the policy and the provider's accepted formats."""
+    formats = PROVIDER_IMAGE_FORMATS if policy == "auto" else [policy]
+    if image.mode not in ("1", "L", "RGB"):
+        image = image.convert("RGB")
+    if image.mode == "RGB" and image.convert("L").convert("RGB").tobytes() == image.tobytes():
+        image = image.convert("L")  # Grey drawings saved as RGB: a third of the bytes, same pixels
+
+    for fmt in formats:
+        buffer = io.BytesIO()
+        if fmt == "png":
+            image.save(buffer, "PNG", optimize=True)
+        elif fmt == "jpeg":
+            (image if image.mode != "1" else image.convert("L")).save(buffer, "JPEG", quality=quality, optimize=True)
+        elif fmt == "webp":
+            image.save(buffer, "WEBP", quality=quality, method=4)
+        elif fmt == "avif":
+            if ".avif" not in Image.registered_extensions():
+                continue  # Needs an AVIF-capable Pillow build or pillow-avif-plugin
+            image.save(buffer, "AVIF", quality=quality)
+        else:
+            continue
+        yield f"image/{fmt}", buffer.getvalue()
+
+
+def encode_image(image_bytes, policy=IMAGE_ENCODING, quality=ENCODING_QUALITY):
+    """Pick the encoding to send: returns (mime, bytes).
+
+    "original" sends the upload as-is with its real MIME type; "auto" also tries every
+    accepted format at the target quality and keeps the smallest; a format name forces it.
+    Uploads in formats the provider won't take are always re-encoded.
+    """
+    mime = sniff_image_mime(image_bytes)
+    accepted = mime is not None and mime.split("/")[1] in PROVIDER_IMAGE_FORMATS
+    if accepted and (policy == "original" or (policy == "auto" and len(image_bytes) < ENCODING_MIN_BYTES)):
+        return mime, image_bytes
+
+    image = load_working_image(image_bytes)
+    candidates = list(encoding_candidates(image, policy if policy != "original" else "png", quality))
+    if accepted and policy == "auto":
+        candidates.append((mime, image_bytes))
+    if not candidates:
+        candidates = list(encoding_candidates(image, "png", quality))
+    return min(candidates, key=lambda c: len(c[1]))
+
+
+def data_url_bytes(mime, size):
+    """Length of the data: URL for size bytes of mime, without building it."""
+    return len(f"data:{mime};base64,") + 4 * math.ceil(size / 3)
+
+
+def fit_image(image_bytes, max_bytes):
+    """Encode an image so its data: URL is at most max_bytes: returns (mime, bytes, reduction).
+
+    Lossy formats are tried at lower quality first, then everything at smaller sizes.
+    Encoded size grows with pixel count, so each step shrinks straight to the side the
+    smallest encoding so far suggests. reduction describes what was given up, or is
+    None when the image fitted as it was; ValueError if even PAYLOAD_MIN_SIDE won't fit.
+    """
+    mime, encoded = encode_image(image_bytes)
+    original = smallest = data_url_bytes(mime, len(encoded))
+    if original <= max_bytes:
+        return mime, encoded, None
+
+    image = load_working_image(image_bytes)
+    policy = IMAGE_ENCODING if IMAGE_ENCODING not in ("auto", "original") else "auto"
+    lossy = [f for f in (PROVIDER_IMAGE_FORMATS if policy == "auto" else [policy]) if f != "png"]
+    first_pass = True  # encode_image has already tried every format at ENCODING_QUALITY and full size
+    while True:
+        attempts = [] if first_pass else [(policy, ENCODING_QUALITY)]
+        if smallest <= 2 * max_bytes:  # Lower quality rarely saves more than half
+            attempts += [(f, q) for f in lossy for q in PAYLOAD_QUALITY_STEPS]
+        for fmt, quality in attempts:
+            for fitted_mime, fitted in encoding_candidates(image, fmt, quality):
+                size = data_url_bytes(fitted_mime, len(fitted))
+                smallest = min(smallest, size)
+                if size <= max_bytes:
+                    return fitted_mime, fitted, {
+                        "original_bytes": original,
+                        "sent_bytes": size,
+                        "max_side": max(image.size),
+                        "quality": quality,
+                        "mime": fitted_mime,
+                    }
+        if max(image.size) <= PAYLOAD_MIN_SIDE:
+            raise ValueError(
+                f"image does not fit the {max_bytes / 1024:,.0f} KiB left in the request "
+                f"even at {max(image.size)}px"
+            )
+        side = int(max(image.size) * min(PAYLOAD_SCALE_STEP, 0.95 * math.sqrt(max_bytes / smallest)))
+        image.thumbnail((max(side, PAYLOAD_MIN_SIDE), max(side, PAYLOAD_MIN_SIDE)))
+        first_pass = False
+
+
+def data_url(mime, encoded):
+    return f"data:{mime};base64," + base64.b64encode(encoded).decode("utf-8")
+
+
+def encode_data_urls(images, max_bytes):
+    """Fit and base64-encode a request's images: returns [(data: URL, reduction)].
+
+    This is the CPU half of a request, run in app.py's process pool.
+    """
+    encoded = []
+    for image_bytes in images:
+        mime, fitted, reduction = fit_image(image_bytes, max_bytes)
+        encoded.append((data_url(mime, fitted), reduction))
+    return encoded
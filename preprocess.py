@@ -0,0 +1,194 @@
+"""Preprocessing stages for scanned drawings, applied before they are encoded and sent.
+
+Each stage takes a PIL image in mode "L" or "RGB" and returns a new image, or the
+same object when it has nothing to change. app.py chains the stages named in
+PREPROCESS_STAGES, runs them in a process pool (see get_preprocess_pool there)
+and caches every stage's output by content hash.
+"""
+import io
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+ANALYSIS_SIDE = 1024  # Stages measure on a copy this size and apply the result at full size
+SKEW_SEARCH_DEGREES = 15.0
+DESKEW_MIN_DEGREES = float(os.getenv("DESKEW_MIN_DEGREES", "0.5"))  # Smaller skew is left alone
+ROTATION_MIN_RATIO = 1.5  # How much more regular the column profile must be before turning a sheet
+TITLE_BLOCK_CORNER = (0.55, 0.7, 1.0, 1.0)  # Where the title block sits on an upright sheet
+THRESHOLD_WINDOW = 1 / 48  # Adaptive threshold neighbourhood, as a share of the long side
+THRESHOLD_OFFSET = 0.15  # Ink is at least this much darker than its neighbourhood mean
+SPECK_WINDOW = 5
+SPECK_MAX_PIXELS = 4  # Ink blobs this small inside a SPECK_WINDOW square are noise
+TRIM_BELOW = float(os.getenv("TRIM_BELOW", "0.8"))  # Trim margins when ink fills less of the sheet than this
+
+
+def to_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=1)  # Fast; the wire format is chosen at encode time
+    return buffer.getvalue()
+
+
+def white(image):
+    return 255 if image.mode == "L" else (255, 255, 255)
+
+
+def analysis_copy(image):
+    """Small greyscale array of the image and the factor back to full size."""
+    small = image.convert("L")
+    small.thumbnail((ANALYSIS_SIDE, ANALYSIS_SIDE))
+    return np.asarray(small, dtype=np.float32), image.width / small.width
+
+
+def ink_mask(grey):
+    low, high = np.percentile(grey, (1, 99))
+    return grey < (low + high) / 2
+
+
+def box_sum(values, window):
+    """Sum over a window x window square around every pixel, via an integral image."""
+    half = window // 2
+    padded = np.pad(values, ((half + 1, half), (half + 1, half)), mode="edge").cumsum(0).cumsum(1)
+    return (
+        padded[window:, window:] - padded[:-window, window:]
+        - padded[window:, :-window] + padded[:-window, :-window]
+    )
+
+
+def estimate_skew(ink):
+    """Angle in degrees the drawing is rotated by, from projection profiles of ink pixels.
+
+    Rows of a level drawing line up, so the row histogram of the rotated ink
+    coordinates is most peaked (largest sum of squares) at the right angle.
+    """
+    ys, xs = np.nonzero(ink)
+    if len(xs) < 50:
+        return 0.0
+    if len(xs) > 200000:
+        keep = np.random.default_rng(0).choice(len(xs), 200000, replace=False)
+        ys, xs = ys[keep], xs[keep]
+    ys, xs = ys.astype(np.float32), xs.astype(np.float32)
+
+    def score(angle):
+        theta = math.radians(angle)
+        rows = ys * math.cos(theta) - xs * math.sin(theta)
+        counts = np.bincount((rows - rows.min()).astype(np.int64))
+        return float(np.dot(counts, counts))
+
+    coarse = max(np.arange(-SKEW_SEARCH_DEGREES, SKEW_SEARCH_DEGREES + 0.5, 0.5), key=score)
+    # Counter-clockwise positive, as in Image.rotate
+    return -float(max(np.arange(coarse - 0.4, coarse + 0.45, 0.1), key=score))
+
+
+def ink_bbox(ink, margin=0.02):
+    """Box around the rows and columns holding ink, ignoring isolated specks, padded by margin."""
+    height, width = ink.shape
+    rows = np.nonzero(ink.sum(axis=1) > max(2, 0.002 * width))[0]
+    cols = np.nonzero(ink.sum(axis=0) > max(2, 0.002 * height))[0]
+    if not len(rows) or not len(cols):
+        return None
+    pad_x, pad_y = int(margin * width), int(margin * height)
+    return (
+        max(0, cols[0] - pad_x), max(0, rows[0] - pad_y),
+        min(width, cols[-1] + 1 + pad_x), min(height, rows[-1] + 1 + pad_y)
+    )
+
+
+def rotate(image):
+    """Turn sheets scanned sideways or upside down upright, in quarter turns.
+
+    Lines of text make the row profile of ink far more uneven than the column
+    profile, which picks between upright/upside-down and the two sideways
+    orientations. Of each pair, the one with the densest ink where the title
+    block belongs wins; upright is kept unless the flip is clearly denser.
+    """
+    grey, _ = analysis_copy(image)
+    ink = ink_mask(grey)
+    if not ink.any():
+        return image
+    unevenness = lambda profile: profile.var() / (profile.mean() ** 2 + 1e-9)
+    sideways = unevenness(ink.sum(axis=0)) > ROTATION_MIN_RATIO * unevenness(ink.sum(axis=1))
+
+    def corner_density(quarter_turns):
+        turned = np.rot90(ink, quarter_turns)  # Counter-clockwise, like Image.rotate
+        height, width = turned.shape
+        left, top, right, bottom = TITLE_BLOCK_CORNER
+        return turned[int(top * height):int(bottom * height), int(left * width):int(right * width)].mean()
+
+    if sideways:
+        turns = max((1, 3), key=corner_density)
+    else:
+        turns = 2 if corner_density(2) > ROTATION_MIN_RATIO * corner_density(0) else 0
+    if turns == 0:
+        return image
+    return image.transpose({1: Image.Transpose.ROTATE_90, 2: Image.Transpose.ROTATE_180,
+                            3: Image.Transpose.ROTATE_270}[turns])
+
+
+def deskew(image):
+    grey, _ = analysis_copy(image)
+    angle = estimate_skew(ink_mask(grey))
+    if abs(angle) < DESKEW_MIN_DEGREES:
+        return image
+    return image.rotate(-angle, resample=Image.BICUBIC, expand=True, fillcolor=white(image))
+
+
+def threshold(image):
+    """Binarise against the local mean (Bradley-Roth), which copes with uneven scan lighting."""
+    grey = np.asarray(image.convert("L"), dtype=np.float32)
+    window = max(15, int(max(grey.shape) * THRESHOLD_WINDOW)) | 1
+    local_mean = box_sum(grey, window) / (window * window)
+    return Image.fromarray(np.where(grey < local_mean * (1 - THRESHOLD_OFFSET), 0, 255).astype(np.uint8))
+
+
+def despeckle(image):
+    """Whiten tiny isolated ink blobs; anything as long as SPECK_WINDOW, such as a thin line, is kept."""
+    pixels = np.array(image)
+    grey = pixels if pixels.ndim == 2 else pixels.mean(axis=2)
+    ink = ink_mask(grey)
+    specks = ink & (box_sum(ink.astype(np.int32), SPECK_WINDOW) <= SPECK_MAX_PIXELS)
+    if not specks.any():
+        return image
+    pixels[specks] = 255
+    return Image.fromarray(pixels)
+
+
+def trim(image):
+    grey, scale = analysis_copy(image)
+    box = ink_bbox(ink_mask(grey))
+    if box is None or (box[2] - box[0]) * (box[3] - box[1]) >= TRIM_BELOW * grey.shape[0] * grey.shape[1]:
+        return image
+    return image.crop(tuple(int(v * scale) for v in box))
+
+
+STAGES = {
+    "rotate": rotate,
+    "deskew": deskew,
+    "threshold": threshold,
+    "despeckle": despeckle,
+    "trim": trim,
+}
+# Bump when a stage's code changes what it outputs, so results cached by the old code are not reused
+PREPROCESS_VERSION = 1
+# Settings each stage's output depends on; app.py puts them into the stage's cache key
+STAGE_PARAMS = {
+    "rotate": {"analysis_side": ANALYSIS_SIDE, "min_ratio": ROTATION_MIN_RATIO, "title_block": TITLE_BLOCK_CORNER},
+    "deskew": {"analysis_side": ANALYSIS_SIDE, "search": SKEW_SEARCH_DEGREES, "min_degrees": DESKEW_MIN_DEGREES},
+    "threshold": {"window": THRESHOLD_WINDOW, "offset": THRESHOLD_OFFSET},
+    "despeckle": {"window": SPECK_WINDOW, "max_pixels": SPECK_MAX_PIXELS},
+    "trim": {"analysis_side": ANALYSIS_SIDE, "below": TRIM_BELOW},
+}
+
+
+def run_stages(image, stages):
+    """Apply stages in order. Returns one PNG per stage, or None where a stage changed nothing."""
+    outputs = []
+    for name in stages:
+        result = STAGES[name](image)
+        if result is image:
+            outputs.append(None)
+            continue
+        image = result
+        outputs.append(to_png(image))
+    return outputs
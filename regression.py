@@ -0,0 +1,207 @@
+"""Regression and accuracy harness over a golden drawing set.
+
+The golden directory holds the drawings and a labels.json:
+
+    {"drawing1.png": {"schema": "cylinder", "expected": {"BORE DIAMETER": "63 MM", ...}}, ...}
+
+Fields left out of "expected" are not scored. Live runs go through the full
+extraction pipeline. Raw model replies can be recorded with --record and replayed
+with --replay, so prompt-independent changes (parsing, validation, export) can be
+checked offline in seconds; a drawing with no recording scores as missing rather
+than calling the API. CASSETTE_MODE=replay does the same for every request,
+including classification and multi-call paths.
+
+Usage: python regression.py golden/ [--replay golden/responses] [--baseline last.json] [--out report.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+
+from app import (
+    DEFAULT_SCHEMA, MANUAL_VALUE, SCHEMAS, extract_drawing, is_pdf, normalize_vote, parse_ai_response, pdf_prepass,
+    to_number
+)
+
+
+def values_match(expected, actual, numeric):
+    if numeric:
+        expected_number, actual_number = to_number(expected), to_number(actual)
+        if expected_number is not None and actual_number is not None:
+            return abs(expected_number - actual_number) < 1e-6
+    return normalize_vote(expected) == normalize_vote(actual)
+
+
+def run_drawing(path, schema, replay_dir=None, record_dir=None, unmatched=None):
+    """Extract one golden drawing; returns (parsed results, reply source, usage, seconds).
+
+    Live runs go through extract_drawing, so the quality gate, preprocessing,
+    classification and the resolution ladder are all exercised. With replay_dir the
+    recorded reply is parsed instead; a drawing without one is never sent live, it
+    comes back empty with source "missing". Reply keys the parser could not map to a
+    field are appended to unmatched.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    name = os.path.basename(path)
+
+    start = time.perf_counter()
+    if replay_dir:
+        # A PDF settled by its text layer never reaches the VLM, so it needs no recording
+        text_fields = {}
+        if is_pdf(data):
+            text_fields, image_bytes = pdf_prepass(data, schema)
+            if image_bytes is None:
+                return text_fields, "text-layer", {}, time.perf_counter() - start
+        recorded = os.path.join(replay_dir, name + ".txt")
+        if not os.path.exists(recorded):
+            return {}, "missing", {}, 0.0
+        with open(recorded, encoding="utf-8") as f:
+            reply = f.read()
+        parsed = {} if reply.startswith("❌") else parse_ai_response(reply, schema, unmatched)
+        return {**parsed, **text_fields}, "replay", {}, time.perf_counter() - start
+
+    meta = {}
+    result = extract_drawing(data, meta=meta)
+    elapsed = time.perf_counter() - start
+
+    # A ladder run is several replies, so only single-reply extractions can be recorded
+    reply = None if "resolution_ladder" in meta else meta.get("reply")
+    if reply is not None:
+        parse_ai_response(reply, SCHEMAS.get(meta.get("schema"), schema), unmatched)
+        if record_dir:
+            os.makedirs(record_dir, exist_ok=True)
+            with open(os.path.join(record_dir, name + ".txt"), "w", encoding="utf-8") as f:
+                f.write(reply)
+    return ({} if isinstance(result, str) else result), "live", meta.get("usage") or {}, elapsed
+
+
+def score(labels, results):
+    """Per-field precision/recall. A wrong value counts as both a false positive and a false negative."""
+    counts = defaultdict(lambda: {"tp": 0, "fp": 0, "fn": 0})
+    outcomes = {}
+    for name, label in labels.items():
+        schema = SCHEMAS.get(label.get("schema"), DEFAULT_SCHEMA)
+        parsed = results.get(name, {})
+        outcomes[name] = {}
+        for field, expected in label["expected"].items():
+            actual = parsed.get(field, "")
+            actual = "" if actual == MANUAL_VALUE else actual
+            key = f"{schema.name}/{field}"
+            if actual and expected and values_match(expected, actual, field in schema.units):
+                counts[key]["tp"] += 1
+                outcomes[name][field] = "correct"
+                continue
+            if actual:
+                counts[key]["fp"] += 1
+            if expected:
+                counts[key]["fn"] += 1
+            outcomes[name][field] = "correct" if not actual and not expected else "wrong" if actual else "missing"
+
+    fields = {}
+    for key, c in sorted(counts.items()):
+        predicted, relevant = c["tp"] + c["fp"], c["tp"] + c["fn"]
+        fields[key] = {
+            **c,
+            "precision": c["tp"] / predicted if predicted else 1.0,
+            "recall": c["tp"] / relevant if relevant else 1.0,
+        }
+    return fields, outcomes
+
+
+def diff_against(baseline, report):
+    """List metric drops and per-drawing fields that were correct in the baseline and no longer are."""
+    regressions = []
+    for key, now in report["fields"].items():
+        before = baseline["fields"].get(key)
+        if not before:
+            continue
+        for metric in ("precision", "recall"):
+            if now[metric] < before[metric] - 1e-9:
+                regressions.append(f"{key} {metric}: {before[metric]:.3f} -> {now[metric]:.3f}")
+    for name, fields in report["outcomes"].items():
+        for field, outcome in fields.items():
+            was = baseline["outcomes"].get(name, {}).get(field)
+            if was == "correct" and outcome != "correct":
+                regressions.append(f"{name} {field}: correct -> {outcome}")
+    return regressions
+
+
+def run(golden_dir, replay_dir=None, record_dir=None, price_in=0.0, price_out=0.0):
+    with open(os.path.join(golden_dir, "labels.json"), encoding="utf-8") as f:
+        labels = json.load(f)
+
+    results, latencies, cost, sources = {}, [], 0.0, defaultdict(int)
+    unmatched = []
+    for name, label in labels.items():
+        schema = SCHEMAS.get(label.get("schema"), DEFAULT_SCHEMA)
+        parsed, source, usage, elapsed = run_drawing(
+            os.path.join(golden_dir, name), schema, replay_dir, record_dir, unmatched
+        )
+        results[name] = parsed
+        latencies.append(elapsed)
+        sources[source] += 1
+        # OpenRouter reports the billed cost directly; otherwise price the tokens
+        cost += usage.get("cost") or (
+            usage.get("prompt_tokens", 0) * price_in + usage.get("completion_tokens", 0) * price_out
+        ) / 1e6
+
+    fields, outcomes = score(labels, results)
+    latencies.sort()
+    return {
+        "created_at": time.time(),
+        "drawings": len(labels),
+        "sources": dict(sources),
+        "latency_p50_s": latencies[len(latencies) // 2] if latencies else None,
+        "latency_p95_s": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+        "latency_total_s": sum(latencies),
+        "cost_usd": cost,
+        "unmatched_keys": dict(Counter(unmatched).most_common()),
+        "fields": fields,
+        "outcomes": outcomes,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("golden_dir")
+    parser.add_argument("--replay", help="Directory of recorded replies to use instead of the API")
+    parser.add_argument("--record", help="Directory to save live replies into")
+    parser.add_argument("--baseline", help="Previous report to diff against")
+    parser.add_argument("--out", help="Where to write this run's report")
+    parser.add_argument("--price-in", type=float, default=0.0, help="USD per 1M prompt tokens")
+    parser.add_argument("--price-out", type=float, default=0.0, help="USD per 1M completion tokens")
+    args = parser.parse_args()
+
+    report = run(args.golden_dir, args.replay, args.record, args.price_in, args.price_out)
+
+    print(f"{report['drawings']} drawings {report['sources']}  p50 {report['latency_p50_s']:.2f}s  "
+          f"p95 {report['latency_p95_s']:.2f}s  cost ${report['cost_usd']:.4f}")
+    print(f"{'field':<40} {'precision':>9} {'recall':>7}")
+    for key, m in report["fields"].items():
+        print(f"{key:<40} {m['precision']:>9.3f} {m['recall']:>7.3f}")
+    if report["unmatched_keys"]:
+        print("\nReply keys matching no field: " + ", ".join(
+            f"{key} ({count})" for key, count in list(report["unmatched_keys"].items())[:10]
+        ))
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = diff_against(json.load(f), report)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nNo regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
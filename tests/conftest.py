@@ -0,0 +1,44 @@
+import io
+import os
+import sys
+import tempfile
+
+import pymupdf
+import pytest
+from PIL import Image, ImageDraw
+
+
+# app.py reads its configuration at import time, so the environment is set before any test imports it
+_scratch = tempfile.mkdtemp(prefix="vlmstream-tests-")
+os.environ.setdefault("API_KEY", "test")
+os.environ["CASSETTE_MODE"] = "off"
+os.environ["ARTIFACT_DIR"] = os.path.join(_scratch, "artifacts")
+os.environ["PREPROCESS_CACHE_DIR"] = os.path.join(_scratch, "preprocess")
+os.environ["RESULTS_DB"] = os.path.join(_scratch, "results.db")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def drawing_png():
+    """A clean line drawing that passes the quality gate."""
+    image = Image.new("L", (800, 600), 255)
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        draw.rectangle((40 + 30 * i, 40 + 20 * i, 760 - 25 * i, 560 - 15 * i), outline=0, width=3)
+        draw.text((60, 50 + 40 * i), f"BORE DIAMETER {40 + i} MM", fill=0)
+    out = io.BytesIO()
+    image.save(out, "PNG")
+    return out.getvalue()
+
+
+@pytest.fixture
+def text_pdf():
+    """Builds a one-page PDF whose text layer holds the given lines."""
+    def build(lines):
+        doc = pymupdf.open()
+        page = doc.new_page()
+        for i, text in enumerate(lines):
+            page.insert_text((72, 72 + 20 * i), text)
+        return doc.tobytes()
+    return build
@@ -0,0 +1,22 @@
+import app
+
+
+def test_sessions_are_forgotten_when_their_artifacts_are_evicted(tmp_path):
+    store = app.ArtifactStore(str(tmp_path), max_bytes=10)
+    store.put("a", b"12345678")
+    store.put("b", b"abcdefgh")  # Over max_bytes: a's only artifact goes
+
+    assert store.stats()["sessions"] == 1
+    assert set(store.sessions) == {"b"}
+
+
+def test_sessions_are_forgotten_when_they_end(tmp_path):
+    live = {"a", "b"}
+    store = app.ArtifactStore(str(tmp_path), is_live=lambda session_id: session_id in live)
+    store.put("a", b"one")
+    store.put("b", b"two")
+
+    live.discard("a")
+
+    assert store.stats()["sessions"] == 1
+    assert set(store.sessions) == {"b"}
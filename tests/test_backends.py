@@ -0,0 +1,54 @@
+import pytest
+
+import app
+import backends
+
+
+def payload(model, images=1):
+    content = [{"type": "text", "text": "Extract", "cache_control": {"type": "ephemeral"}}]
+    content += [{"type": "image_url", "image_url": "data:image/png;base64,AAAA"}] * images
+    return {"model": model, "messages": [{"role": "user", "content": content}], "usage": {"include": True}}
+
+
+def test_mistral_maps_each_requested_model():
+    backend = backends.MistralBackend(
+        "mistral", "", model="pixtral-large-latest", models=backends.parse_model_map("qwen/qwen2.5-vl-72b-instruct=pixtral-12b")
+    )
+
+    assert backend.model_for("qwen/qwen2.5-vl-72b-instruct") == "pixtral-12b"
+    assert backend.model_for("mistralai/mistral-small-3.1-24b-instruct") == "mistral-small-3.1-24b-instruct"
+    assert backend.model_for("google/gemini-flash-1.5") == "pixtral-large-latest"
+
+
+def test_openai_compatible_payload_drops_openrouter_fields():
+    backend = backends.OpenAICompatibleBackend("local", "http://localhost/v1/chat/completions")
+
+    prepared = backend.prepare(payload("qwen/qwen2.5-vl-72b-instruct"))
+
+    assert prepared["model"] == "qwen/qwen2.5-vl-72b-instruct"  # No fixed model: sent as requested
+    assert "usage" not in prepared
+    assert all("cache_control" not in part for part in prepared["messages"][0]["content"])
+
+
+def test_route_skips_backends_that_cannot_take_several_images():
+    single = backends.OpenAICompatibleBackend("local", "http://localhost/v1/chat/completions")
+    multi = backends.OpenAICompatibleBackend("openai", "http://localhost/v1/chat/completions", multi_image=True)
+
+    assert backends.route([single, multi], payload("m", images=2), strategy="first") is multi
+    assert backends.route([single], payload("m", images=2)) is None
+
+
+def test_oversized_request_is_refused_before_sending():
+    backend = backends.OpenAICompatibleBackend("local", "http://localhost:9/v1/chat/completions")
+
+    with pytest.raises(backends.RequestTooLarge):
+        backend.complete(payload("m"), max_bytes=10)
+    assert backend.expected_latency() == 0.0  # Not held against the backend
+
+
+def test_cassette_fingerprint_ignores_key_order():
+    a = {"model": "m", "messages": [], "temperature": 0}
+    b = {"temperature": 0, "messages": [], "model": "m"}
+
+    assert app.Cassette.fingerprint(a) == app.Cassette.fingerprint(b)
+    assert app.Cassette.fingerprint(a) != app.Cassette.fingerprint({**a, "model": "n"})
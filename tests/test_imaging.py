@@ -0,0 +1,28 @@
+import io
+
+import pytest
+from PIL import Image
+
+import imaging
+
+
+def encoded(image, fmt, **params):
+    out = io.BytesIO()
+    image.save(out, fmt, **params)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("fmt, params", [("PNG", {}), ("TIFF", {"compression": "group4"})])
+def test_compressed_scan_over_the_budget_is_rejected_with_advice(fmt, params):
+    data = encoded(Image.new("1", (2000, 1500), 1), fmt, **params)
+
+    with pytest.raises(ValueError, match="Save it as JPEG or uncompressed TIFF"):
+        imaging.load_working_image(data, max_side=500, max_pixels=1000 * 1000)
+
+
+def test_uncompressed_scan_over_the_budget_is_reduced_in_bands():
+    data = encoded(Image.new("L", (2000, 1500), 255), "TIFF")
+
+    image = imaging.load_working_image(data, max_side=500, max_pixels=1000 * 1000)
+
+    assert image.size == (500, 375)
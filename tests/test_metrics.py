@@ -0,0 +1,27 @@
+import threading
+
+import app
+
+
+def test_queue_depth_counts_down_from_many_threads():
+    metrics = app.Metrics()
+    queued = app.QueueDepth(metrics, 4000)
+
+    threads = [threading.Thread(target=lambda: [queued.dequeue() for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert queued.count == 0
+    assert metrics.gauges["queue_depth"] == 0
+
+
+def test_queue_depth_clear_leaves_no_residue():
+    metrics = app.Metrics()
+    queued = app.QueueDepth(metrics, 5)
+    queued.dequeue()
+    queued.clear()
+    queued.dequeue()  # A straggler after the run ended
+
+    assert metrics.gauges["queue_depth"] == 0
@@ -0,0 +1,19 @@
+import json
+
+import app
+
+
+def test_batch_items_are_normalised_like_single_replies():
+    schema = app.SCHEMAS["cylinder"]
+    item = {"- **Bore Dia (mm)**": "63 MM", "Stroke": "\"250 MM\"", "ROD DIAMETER": "N/A", "Colour": "red"}
+    single = app.parse_ai_response("\n".join(f"{k}: {v}" for k, v in item.items()), schema)
+
+    batched = app.parse_batch_response(json.dumps([item, {}]), 2, schema)
+
+    assert batched[0] == single
+    assert batched[0] == {"BORE DIAMETER": "63 MM", "STROKE LENGTH": "250 MM", "ROD DIAMETER": app.MANUAL_VALUE}
+    assert batched[1] == {}
+
+
+def test_batch_reply_of_wrong_length_is_rejected():
+    assert app.parse_batch_response(json.dumps([{"BORE DIAMETER": "63"}]), 2) is None
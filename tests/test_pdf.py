@@ -0,0 +1,53 @@
+from streamlit.testing.v1 import AppTest
+
+import app
+
+
+CORRUPT_PDF = b"%PDF-1.4\n% truncated in transfer"
+
+
+def test_corrupt_pdf_falls_back_to_the_default_schema():
+    assert app.classify_drawing(CORRUPT_PDF) is app.DEFAULT_SCHEMA
+
+
+def batch_page():
+    import io
+
+    import streamlit as st
+
+    import app
+
+    class Upload(io.BytesIO):
+        def __init__(self, name, data):
+            super().__init__(data)
+            self.name = name
+
+    # Streamlit runs this as __main__ and leaves it there, so preprocessing workers spawned later re-run it
+    if __name__ == "__main__":
+        uploader, button = st.file_uploader, st.button
+        st.file_uploader = lambda *a, **k: [Upload(name, data) for name, data in st.session_state.drawings]
+        st.button = lambda label, *a, **k: label == "Process Drawings"
+        try:
+            app.batch_section()
+        finally:
+            st.file_uploader, st.button = uploader, button
+
+
+def test_corrupt_pdf_in_a_batch_is_an_error_row(text_pdf):
+    good = text_pdf(["HYDRAULIC CYLINDER", "BORE DIA 63", "ROD DIA 36", "STROKE 250", "DWG NO. HC-2041"])
+    page = AppTest.from_function(batch_page, default_timeout=60)
+    page.session_state.drawings = [("good.pdf", good), ("broken.pdf", CORRUPT_PDF)]
+    page.run()
+
+    assert not page.exception
+    assert [e.value for e in page.error] and page.error[0].value.startswith("broken.pdf: ❌ Processing Error")
+    assert page.dataframe[0].value["FILE"].tolist() == ["good.pdf"]
+
+
+def test_pdf_vlm_call_is_metered_by_the_governor(text_pdf, monkeypatch):
+    monkeypatch.setattr(app, "get_backends", lambda: [])  # Any request that got through would be an API error
+    governor = app.BudgetGovernor(batch_limit=1)
+
+    result = app.extract_drawing(text_pdf(["BORE DIA 63"]), schema=app.SCHEMAS["cylinder"], governor=governor)
+
+    assert result.startswith("❌ Budget Error")
@@ -0,0 +1,19 @@
+import app
+
+
+def cached_stages(image_bytes, stages):
+    meta = {}
+    app.preprocess_drawing(image_bytes, stages, meta)
+    return meta["preprocess"]["cached_stages"]
+
+
+def test_changed_stage_settings_or_version_miss_the_cache(drawing_png, monkeypatch):
+    image_bytes = drawing_png + b"cache-test"  # Trailing bytes after IEND: new hash, same image
+    assert cached_stages(image_bytes, ["trim"]) == 0
+    assert cached_stages(image_bytes, ["trim"]) == 1
+
+    monkeypatch.setitem(app.STAGE_PARAMS, "trim", {**app.STAGE_PARAMS["trim"], "below": 0.5})
+    assert cached_stages(image_bytes, ["trim"]) == 0
+
+    monkeypatch.setattr(app, "PREPROCESS_VERSION", app.PREPROCESS_VERSION + 1)
+    assert cached_stages(image_bytes, ["trim"]) == 0
@@ -0,0 +1,27 @@
+import io
+
+from PIL import Image, ImageFilter
+
+import app
+
+
+def png(image):
+    out = io.BytesIO()
+    image.save(out, "PNG")
+    return out.getvalue()
+
+
+def test_all_black_page_is_too_dark():
+    result = app.quality_gate(png(Image.new("L", (800, 600), 0)))
+
+    assert result == "❌ Processing Error: rejected by quality gate: too dark (mean brightness 0%)"
+
+
+def test_blurred_scan_is_reported_as_blurred_before_dark(drawing_png):
+    dark_blur = Image.open(io.BytesIO(drawing_png)).point(lambda v: v * 0.3).filter(ImageFilter.GaussianBlur(8))
+
+    assert "too blurred" in app.quality_gate(png(dark_blur))
+
+
+def test_clean_drawing_passes(drawing_png):
+    assert not isinstance(app.quality_gate(drawing_png), str)
@@ -0,0 +1,23 @@
+import app
+import regression
+
+
+def test_replay_scores_text_layer_pdfs_without_a_recording(tmp_path, text_pdf):
+    drawing = tmp_path / "cylinder.pdf"
+    drawing.write_bytes(text_pdf(["BORE DIA 63", "ROD DIA 36", "STROKE 250", "DWG NO. HC-2041"]))
+    replay_dir = tmp_path / "responses"
+    replay_dir.mkdir()
+
+    parsed, source, _, _ = regression.run_drawing(str(drawing), app.SCHEMAS["cylinder"], replay_dir=str(replay_dir))
+
+    assert source == "text-layer"
+    assert parsed["BORE DIAMETER"] == "63 MM"
+
+
+def test_replay_reports_missing_when_the_vlm_would_be_called(tmp_path, text_pdf):
+    drawing = tmp_path / "cylinder.pdf"
+    drawing.write_bytes(text_pdf(["BORE DIA 63"]))
+    replay_dir = tmp_path / "responses"
+    replay_dir.mkdir()
+
+    assert regression.run_drawing(str(drawing), app.SCHEMAS["cylinder"], replay_dir=str(replay_dir))[1] == "missing"
@@ -0,0 +1,25 @@
+import app
+
+
+def line(text, x0=10, y0=10):
+    return (x0, y0, x0 + 8 * len(text), y0 + 10, text)
+
+
+def test_drawing_number_skips_header_words():
+    schema = app.SCHEMAS["cylinder"]
+    header = line("DRAWING NO.  SCALE  SHEET")
+    value = line("HC-2041-B", y0=22)
+
+    assert app.extract_text_layer_fields([header, value], schema)["DRAWING NUMBER"] == "HC-2041-B"
+    assert "DRAWING NUMBER" not in app.extract_text_layer_fields([header], schema)
+
+
+def test_numeric_fields_convert_the_written_unit():
+    schema = app.SCHEMAS["cylinder"]
+    lines = [line("STROKE 8 IN"), line("BORE Ø 63", y0=30), line("ROD DIA 1.5 BAR", y0=50)]
+
+    fields = app.extract_text_layer_fields(lines, schema)
+
+    assert fields["STROKE LENGTH"] == "203.2 MM"
+    assert fields["BORE DIAMETER"] == "63 MM"
+    assert "ROD DIAMETER" not in fields  # Stated in a unit that is no length
@@ -0,0 +1,42 @@
+import os
+import threading
+
+import app
+import watch
+
+
+def test_overwritten_file_is_picked_up_again(tmp_path):
+    path = tmp_path / "a.png"
+    path.write_bytes(b"first")
+    watcher = watch.FolderWatcher([str(tmp_path)], settle=0)
+
+    assert watcher.scan() == []
+    assert watcher.scan() == [str(path)]
+    watcher.done(str(path), True)
+    assert watcher.scan() == []
+
+    path.write_bytes(b"second")
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))  # Same size, same second on coarse clocks
+
+    assert watcher.scan() == []
+    assert watcher.scan() == [str(path)]
+
+
+def test_permanent_reject_is_done_and_api_error_is_retried(tmp_path, monkeypatch, drawing_png):
+    store = app.ResultsStore(str(tmp_path / "results.db"))
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"\x89PNG\r\n\x1a\n not really")
+    good = tmp_path / "good.png"
+    good.write_bytes(drawing_png)
+    monkeypatch.setattr(app, "get_backends", lambda: [])  # Every request fails with an API error
+
+    assert watch.process_file(str(broken), store, set(), threading.Lock()) is True
+    assert watch.process_file(str(good), store, set(), threading.Lock()) is False
+
+    watcher = watch.FolderWatcher([str(tmp_path)], settle=0)
+    watcher.scan()
+    watcher.scan()
+    watcher.done(str(broken), True)
+    watcher.done(str(good), False)
+    assert str(good) in watcher.failures and str(broken) in watcher.seen
@@ -0,0 +1,165 @@
+"""Watch-folder ingestion daemon.
+
+Picks up drawings that scanners and plotters drop into shared directories,
+runs them through the extraction pipeline and writes results to the results store.
+
+Usage: python watch.py /mnt/scans /mnt/plots [--workers 4] [--settle 5]
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import RESULTS_DB, BudgetGovernor, ResultsStore, content_hash, extract_drawing, revision_image
+from imaging import DECODE_ERRORS
+
+WATCH_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".pdf")
+# A file that failed is tried again after RETRY_DELAY seconds, doubling with each failure up to RETRY_MAX_DELAY
+RETRY_DELAY = 60.0
+RETRY_MAX_DELAY = 3600.0
+# Only these failures are retried: the provider, the network or the token budget may recover.
+# Anything else (quality gate, undecodable file, no recording to replay) fails the same way every time.
+TRANSIENT_ERRORS = ("❌ API Error", "❌ Budget Error")
+
+log = logging.getLogger("watch")
+
+
+class FolderWatcher:
+    """Polls directories for new files and hands over the ones that have finished being written.
+
+    Network shares don't deliver inotify events for writes made by other hosts,
+    so directories are rescanned every interval instead. A file counts as complete
+    once its size and mtime have stayed unchanged for settle seconds. A file
+    overwritten under the same name is picked up again.
+    """
+
+    def __init__(self, directories, settle=5.0):
+        self.directories = directories
+        self.settle = settle
+        self.pending = {}  # path -> (size, mtime_ns, first time this size/mtime was seen)
+        self.seen = {}  # path -> (size, mtime_ns) of the version handed out
+        self.failures = {}  # path -> (failed attempts, time of the next attempt)
+
+    def scan(self):
+        """Return paths that are new and stable since the last scan."""
+        now = time.monotonic()
+        ready = []
+        present = set()
+        for directory in self.directories:
+            for entry in os.scandir(directory):
+                if not entry.is_file() or not entry.name.lower().endswith(WATCH_EXTENSIONS):
+                    continue
+                present.add(entry.path)
+                stat = entry.stat()
+                version = (stat.st_size, stat.st_mtime_ns)
+                if entry.path in self.seen:
+                    if self.seen[entry.path] == version:
+                        continue
+                    # Overwritten since it was handed out: a new drawing under the old name
+                    del self.seen[entry.path]
+                    self.failures.pop(entry.path, None)
+                if self.failures.get(entry.path, (0, now))[1] > now:
+                    continue
+                size, mtime, since = self.pending.get(entry.path, (None, None, now))
+                if (size, mtime) != version:
+                    self.pending[entry.path] = version + (now,)
+                elif size > 0 and now - since >= self.settle:
+                    del self.pending[entry.path]
+                    self.seen[entry.path] = version
+                    ready.append(entry.path)
+
+        # Forget deleted files so a rescan of the same name is picked up again
+        for path in set(self.seen) - present:
+            del self.seen[path]
+        for path in set(self.pending) - present:
+            del self.pending[path]
+        for path in set(self.failures) - present:
+            del self.failures[path]
+        return ready
+
+    def done(self, path, ok):
+        """Record how processing a path went; a failed one is handed out again once its retry delay passes."""
+        if ok:
+            self.failures.pop(path, None)
+            return
+        attempts = self.failures.get(path, (0, None))[0] + 1
+        self.failures[path] = (attempts, time.monotonic() + min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** (attempts - 1)))
+        self.seen.pop(path, None)
+
+
+def process_file(path, store, in_flight, lock, governor=None):
+    """Extract one drawing into the store; returns False if it failed in a way worth retrying.
+
+    A drawing rejected for good (quality gate, undecodable file) is logged and counts as done.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = content_hash(data)
+    with lock:
+        duplicate = digest in in_flight or store.has(digest)
+        if not duplicate:
+            in_flight.add(digest)
+    if duplicate:
+        log.info("skip duplicate %s", path)
+        return True
+    try:
+        start = time.perf_counter()
+        result = extract_drawing(data, governor=governor)
+        if isinstance(result, str):
+            log.error("%s: %s", path, result)
+            return not result.startswith(TRANSIENT_ERRORS)
+        try:
+            image = revision_image(data)  # Lets the next revision of this drawing be diffed against it
+        except DECODE_ERRORS:
+            image = None
+        store.save(digest, path, result, image)
+        log.info("extracted %s in %.1fs", path, time.perf_counter() - start)
+        return True
+    finally:
+        with lock:
+            in_flight.discard(digest)
+
+
+def log_failure(path, future):
+    if future.exception() is not None:
+        log.error("%s: %s", path, future.exception(), exc_info=future.exception())
+
+
+def run(directories, workers=4, settle=5.0, interval=2.0, db=RESULTS_DB):
+    store = ResultsStore(db)
+    watcher = FolderWatcher(directories, settle)
+    in_flight = set()
+    lock = threading.Lock()
+    governor = BudgetGovernor(batch_limit=0)  # A daemon has no batch; only the hourly budget applies
+    futures = {}  # future -> path
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for future in [f for f in futures if f.done()]:
+                watcher.done(futures.pop(future), future.exception() is None and future.result())
+            # Leave new files for the next scan while the pool is saturated
+            if len(futures) < workers * 2:
+                for path in watcher.scan():
+                    future = executor.submit(process_file, path, store, in_flight, lock, governor)
+                    future.add_done_callback(lambda f, path=path: log_failure(path, f))
+                    futures[future] = path
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directories", nargs="+")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent API calls")
+    parser.add_argument("--settle", type=float, default=5.0,
+                        help="Seconds a file must stay unchanged before it is processed")
+    parser.add_argument("--interval", type=float, default=2.0, help="Seconds between directory scans")
+    parser.add_argument("--db", default=RESULTS_DB, help="Results store path")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    run(args.directories, args.workers, args.settle, args.interval, args.db)
+
+
+if __name__ == "__main__":
+    main()